@@ -0,0 +1,232 @@
+import contextvars
+import datetime
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Optional
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from checkpoints import CHECKPOINT_DIR
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Daily limits per API key; 0 means unlimited. Days start at midnight UTC
+DAILY_TOKEN_BUDGET = int(os.getenv("DAILY_TOKEN_BUDGET", "0"))
+DAILY_NOTION_REQUEST_BUDGET = int(os.getenv("DAILY_NOTION_REQUEST_BUDGET", "0"))
+# Share of the token budget after which summaries use the fallback model
+DEGRADE_AT_FRACTION = float(os.getenv("DEGRADE_AT_FRACTION", "0.8"))
+OPENROUTER_FALLBACK_MODEL = os.getenv("OPENROUTER_FALLBACK_MODEL")
+
+USAGE_FIELDS = (
+    "llm_requests",
+    "prompt_tokens",
+    "completion_tokens",
+    "cost",
+    "download_bytes",
+    "notion_requests",
+)
+# Usage outside any API key, e.g. bulk_convert or jobs from before accounting
+ANONYMOUS_KEY = "anonymous"
+
+_COLUMNS = ",\n    ".join(
+    f"{name} {'REAL' if name == 'cost' else 'INTEGER'} NOT NULL DEFAULT 0"
+    for name in USAGE_FIELDS
+)
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS daily_usage (
+    day TEXT NOT NULL,
+    api_key TEXT NOT NULL,
+    {_COLUMNS},
+    PRIMARY KEY (day, api_key)
+);
+CREATE TABLE IF NOT EXISTS job_usage (
+    job_id TEXT PRIMARY KEY,
+    api_key TEXT NOT NULL,
+    day TEXT NOT NULL,
+    {_COLUMNS}
+);
+"""
+
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    """Identify an API key in usage records without storing the key itself."""
+    if not api_key:
+        return ANONYMOUS_KEY
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+@dataclass(frozen=True)
+class UsageScope:
+    job_id: Optional[str] = None
+    api_key: str = ANONYMOUS_KEY
+
+
+_current_scope = contextvars.ContextVar("usage_scope", default=UsageScope())
+
+
+def current_scope() -> UsageScope:
+    """Return the job and API key usage in this context is charged to."""
+    return _current_scope.get()
+
+
+@contextmanager
+def usage_scope(job_id: str = None, api_key: str = None):
+    """
+    Charge usage in the enclosed block to a job and an API key fingerprint.
+
+    Either may be omitted to keep the value of an enclosing scope.
+    """
+    scope = current_scope()
+    if job_id is not None:
+        scope = replace(scope, job_id=job_id)
+    if api_key is not None:
+        scope = replace(scope, api_key=api_key)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+
+
+def _today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+
+def seconds_until_reset() -> int:
+    """Seconds until the daily budgets reset at midnight UTC."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    tomorrow = datetime.datetime.combine(
+        now.date() + datetime.timedelta(days=1),
+        datetime.time(),
+        tzinfo=datetime.timezone.utc,
+    )
+    return int((tomorrow - now).total_seconds()) + 1
+
+
+class UsageLedger:
+    """Daily and per-job usage totals, persisted next to the checkpoint store."""
+
+    def __init__(self, path: str = os.path.join(CHECKPOINT_DIR, "usage.sqlite3")):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def record(self, **amounts):
+        """Add usage, e.g. record(notion_requests=1), to the current scope."""
+        scope = current_scope()
+        day = _today()
+        columns = ", ".join(amounts)
+        placeholders = ", ".join("?" for _ in amounts)
+        increments = ", ".join(f"{name} = {name} + excluded.{name}" for name in amounts)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                f"INSERT INTO daily_usage (day, api_key, {columns})"
+                f" VALUES (?, ?, {placeholders})"
+                f" ON CONFLICT (day, api_key) DO UPDATE SET {increments}",
+                (day, scope.api_key, *amounts.values()),
+            )
+            if scope.job_id is not None:
+                self._conn.execute(
+                    f"INSERT INTO job_usage (job_id, api_key, day, {columns})"
+                    f" VALUES (?, ?, ?, {placeholders})"
+                    f" ON CONFLICT (job_id) DO UPDATE SET {increments}",
+                    (scope.job_id, scope.api_key, day, *amounts.values()),
+                )
+            self._conn.execute("COMMIT")
+
+    def today(self, api_key: str) -> dict:
+        """Today's totals for one API key fingerprint."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM daily_usage WHERE day = ? AND api_key = ?",
+                (_today(), api_key),
+            ).fetchone()
+        return {name: row[name] if row else 0 for name in USAGE_FIELDS}
+
+    def daily_totals(self, days: int = 7) -> list:
+        """Totals per day and API key fingerprint, most recent first."""
+        since = (
+            datetime.datetime.now(datetime.timezone.utc).date()
+            - datetime.timedelta(days=days - 1)
+        ).isoformat()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM daily_usage WHERE day >= ? ORDER BY day DESC, api_key",
+                (since,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def job_usage(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM job_usage WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+
+ledger = UsageLedger()
+
+
+class BudgetExceeded(HTTPException):
+    """A daily budget is used up; the job should wait until it resets."""
+
+    def __init__(self, detail: str):
+        retry_after = seconds_until_reset()
+        self.reason = detail
+        self.retry_after = retry_after
+        super().__init__(
+            status_code=429,
+            detail=f"{detail}; retry in {retry_after} seconds",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+def choose_model(model: str) -> str:
+    """
+    Return the model the next completion should use under today's token budget.
+
+    Raises:
+        BudgetExceeded: If the current API key has used its whole token budget
+    """
+    if not DAILY_TOKEN_BUDGET:
+        return model
+    api_key = current_scope().api_key
+    usage = ledger.today(api_key)
+    tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+    if tokens >= DAILY_TOKEN_BUDGET:
+        logger.warning(f"Daily token budget exhausted for key {api_key}")
+        raise BudgetExceeded("Daily token budget exhausted")
+    if OPENROUTER_FALLBACK_MODEL and tokens >= DAILY_TOKEN_BUDGET * DEGRADE_AT_FRACTION:
+        logger.info(
+            f"Key {api_key} has used {tokens} of {DAILY_TOKEN_BUDGET} tokens today; "
+            f"using {OPENROUTER_FALLBACK_MODEL}"
+        )
+        return OPENROUTER_FALLBACK_MODEL
+    return model
+
+
+def check_notion_budget():
+    """
+    Raises:
+        BudgetExceeded: If the current API key has used its Notion request budget
+    """
+    if not DAILY_NOTION_REQUEST_BUDGET:
+        return
+    api_key = current_scope().api_key
+    if ledger.today(api_key)["notion_requests"] >= DAILY_NOTION_REQUEST_BUDGET:
+        logger.warning(f"Daily Notion request budget exhausted for key {api_key}")
+        raise BudgetExceeded("Daily Notion request budget exhausted")
@@ -0,0 +1,338 @@
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from scheduler import (
+    PRIORITIES,
+    TENANT_WEIGHTS,
+    FairQueue,
+    JobContext,
+    WaitStats,
+    current_job,
+)
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Global budget for bytes held in memory across all in-flight jobs
+# (downloaded PDFs being extracted plus extracted text awaiting the LLM)
+MAX_INFLIGHT_BYTES = int(os.getenv("MAX_INFLIGHT_BYTES", str(256 * 1024 * 1024)))
+# Largest single file we are willing to process at all
+MAX_FILE_BYTES = int(os.getenv("MAX_FILE_BYTES", str(64 * 1024 * 1024)))
+# Jobs admitted to the pipeline at once (running or waiting for a stage)
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "8"))
+# Jobs that may wait for a slot once MAX_QUEUED_JOBS are admitted; beyond
+# this every new job is rejected, whichever workspace it claims to be from
+MAX_WAITING_JOBS = int(os.getenv("MAX_WAITING_JOBS", str(MAX_QUEUED_JOBS)))
+# Job slots only interactive requests may use, so backfills cannot lock them out
+RESERVED_INTERACTIVE_JOBS = int(os.getenv("RESERVED_INTERACTIVE_JOBS", "2"))
+# How long a job may wait for a stage slot or byte budget before giving up
+STAGE_WAIT_SECONDS = float(os.getenv("STAGE_WAIT_SECONDS", "120"))
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", "30"))
+# How often an async caller checks whether its queued job has been admitted
+ADMIT_POLL_SECONDS = 0.05
+
+# Download and extraction stages are registered per fetcher and converter
+STAGE_LIMITS = {
+    "llm": int(os.getenv("LLM_CONCURRENCY", "2")),
+    "embed": int(os.getenv("EMBED_CONCURRENCY", "1")),
+    "notion": int(os.getenv("NOTION_CONCURRENCY", "2")),
+}
+
+
+# Bytes already reserved by the enclosing reservations of the current job
+_reserved_bytes = contextvars.ContextVar("reserved_bytes", default=0)
+
+
+def _overloaded(status_code: int, detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=status_code,
+        detail=detail,
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+    )
+
+
+class AdmissionController:
+    """
+    Bounds the work held by the pipeline at any one time.
+
+    Jobs are admitted up to a fixed queue size, each stage has its own
+    concurrency limit and large in-memory payloads must reserve space in a
+    shared byte budget before they are loaded. Jobs waiting for a stage are
+    served by priority class and then fairly across tenants (see FairQueue).
+
+    When every job slot is taken, a job from a tenant holding less than its
+    weighted share of the slots waits for the next free one instead of being
+    rejected, so one workspace filling the pipeline cannot lock out the rest.
+    Queued jobs count towards their tenant's share, and at most
+    MAX_WAITING_JOBS may queue in total; anything else is turned away with 429.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = MAX_INFLIGHT_BYTES,
+        max_jobs: int = MAX_QUEUED_JOBS,
+        max_waiting: int = MAX_WAITING_JOBS,
+        stage_limits: dict = None,
+        wait_seconds: float = STAGE_WAIT_SECONDS,
+    ):
+        self.max_bytes = max_bytes
+        self.max_jobs = max_jobs
+        self.max_waiting = max_waiting
+        self.wait_seconds = wait_seconds
+        self.stage_limits = dict(stage_limits or STAGE_LIMITS)
+        self.in_flight_bytes = 0
+        self.active_jobs = 0
+        self.stage_active = {name: 0 for name in self.stage_limits}
+        self.queues = {name: FairQueue() for name in self.stage_limits}
+        self.active_by_class = dict.fromkeys(PRIORITIES, 0)
+        self.active_by_tenant = Counter()
+        self.admission_queue = FairQueue()
+        self.wait_stats = {priority: WaitStats() for priority in PRIORITIES}
+        self._cond = threading.Condition()
+
+    def _job_limit(self, job: JobContext) -> int:
+        if job.priority == "interactive":
+            return self.max_jobs
+        return self.max_jobs - RESERVED_INTERACTIVE_JOBS
+
+    def _tenant_jobs(self) -> Counter:
+        """Admitted and queued jobs per tenant. Callers hold the lock."""
+        jobs = Counter(self.active_by_tenant)
+        jobs.update(waiter.tenant for waiter in self.admission_queue.waiters)
+        return jobs
+
+    def tenant_share(self, tenant: str) -> float:
+        """Job slots a tenant is entitled to among the tenants now active or queued."""
+        tenants = {name for name, count in self._tenant_jobs().items() if count}
+        tenants.add(tenant)
+        total = sum(TENANT_WEIGHTS.get(name, 1.0) for name in tenants)
+        return self.max_jobs * TENANT_WEIGHTS.get(tenant, 1.0) / total
+
+    def _enter(self, job: JobContext):
+        """
+        Take a job slot, or queue for one. Callers hold the lock.
+
+        Returns:
+            The queued waiter, or None if the job was admitted straight away
+        """
+        if self.active_jobs < self._job_limit(job) and not self.admission_queue.waiters:
+            self._take_slot(job)
+            return None
+        waiting = len(self.admission_queue.waiters)
+        tenant_jobs = self._tenant_jobs()[job.tenant]
+        if waiting >= self.max_waiting or tenant_jobs >= self.tenant_share(job.tenant):
+            logger.warning(
+                f"Rejecting {job.priority} job from {job.tenant}: "
+                f"{self.active_jobs} of {self.max_jobs} slots in use, "
+                f"{waiting} jobs queued, {tenant_jobs} by this tenant"
+            )
+            raise _overloaded(429, "Too many conversions in progress")
+        return self.admission_queue.push(job)
+
+    def _take_slot(self, job: JobContext):
+        self.active_jobs += 1
+        self.active_by_class[job.priority] += 1
+        self.active_by_tenant[job.tenant] += 1
+
+    def _try_admit(self, job: JobContext, waiter) -> bool:
+        """Admit a queued job if it is next and a slot is free. Callers hold the lock."""
+        if (
+            self.active_jobs < self._job_limit(job)
+            and self.admission_queue.head() is waiter
+        ):
+            self.admission_queue.grant(waiter)
+            self._take_slot(job)
+            # Another waiter may fit in a remaining slot
+            self._cond.notify_all()
+            return True
+        return False
+
+    def _abandon(self, waiter):
+        self.admission_queue.remove(waiter)
+        self._cond.notify_all()
+        logger.warning("Timed out waiting for a job slot")
+
+    def _leave(self, job: JobContext):
+        with self._cond:
+            self.active_jobs -= 1
+            self.active_by_class[job.priority] -= 1
+            self.active_by_tenant[job.tenant] -= 1
+            if not self.active_by_tenant[job.tenant]:
+                del self.active_by_tenant[job.tenant]
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self):
+        """
+        Admit a job to the pipeline from a worker thread.
+
+        Raises:
+            HTTPException: 429 if the pipeline is full and the job's tenant
+                already has its share, or no slot freed up in time
+        """
+        job = current_job()
+        with self._cond:
+            waiter = self._enter(job)
+            if waiter is not None and not self._cond.wait_for(
+                lambda: self._try_admit(job, waiter), timeout=self.wait_seconds
+            ):
+                self._abandon(waiter)
+                raise _overloaded(429, "Too many conversions in progress")
+        try:
+            yield self
+        finally:
+            self._leave(job)
+
+    @asynccontextmanager
+    async def admit_async(self):
+        """Like admit, for request handlers; waiting does not block the event loop."""
+        job = current_job()
+        with self._cond:
+            waiter = self._enter(job)
+        if waiter is not None:
+            deadline = time.monotonic() + self.wait_seconds
+            try:
+                while True:
+                    with self._cond:
+                        if self._try_admit(job, waiter):
+                            break
+                        if time.monotonic() >= deadline:
+                            self._abandon(waiter)
+                            raise _overloaded(429, "Too many conversions in progress")
+                    await asyncio.sleep(ADMIT_POLL_SECONDS)
+            except asyncio.CancelledError:
+                # The client went away while its job was queued
+                with self._cond:
+                    self.admission_queue.remove(waiter)
+                    self._cond.notify_all()
+                raise
+        try:
+            yield self
+        finally:
+            self._leave(job)
+
+    def register_stage(self, name: str, limit: int):
+        """Add a stage with its own concurrency limit."""
+        with self._cond:
+            self.stage_limits[name] = limit
+            self.stage_active.setdefault(name, 0)
+            self.queues.setdefault(name, FairQueue())
+
+    @contextmanager
+    def stage(self, name: str):
+        """Hold one of the concurrency slots for a pipeline stage."""
+        job = current_job()
+        queue = self.queues[name]
+        with self._cond:
+            waiter = queue.push(job)
+            if not self._cond.wait_for(
+                lambda: self.stage_active[name] < self.stage_limits[name]
+                and queue.head() is waiter,
+                timeout=self.wait_seconds,
+            ):
+                queue.remove(waiter)
+                self._cond.notify_all()
+                logger.warning(f"Timed out waiting for a {name} slot")
+                raise _overloaded(503, f"Pipeline stage '{name}' is saturated")
+            self.wait_stats[job.priority].record(queue.grant(waiter))
+            self.stage_active[name] += 1
+            # The next waiter may fit in a remaining slot
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.stage_active[name] -= 1
+                self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int, standalone: bool = False):
+        """
+        Reserve part of the global byte budget while a payload is in memory.
+
+        A nested reservation only waits for the bytes its enclosing ones do
+        not already cover, e.g. an LLM payload built from extracted text that
+        is held against the budget until it has been summarised. Otherwise a
+        job could wait on budget that it holds itself.
+
+        Args:
+            nbytes: Size of the payload
+            standalone: Count the payload in full, for a reservation that
+                outlives the ones enclosing it
+        """
+        if nbytes > self.max_bytes or nbytes > MAX_FILE_BYTES:
+            raise HTTPException(
+                status_code=413, detail="File is too large to be processed"
+            )
+        extra = nbytes if standalone else max(0, nbytes - _reserved_bytes.get())
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self.in_flight_bytes + extra <= self.max_bytes,
+                timeout=self.wait_seconds,
+            ):
+                logger.warning(
+                    f"Timed out reserving {extra} bytes "
+                    f"({self.in_flight_bytes} of {self.max_bytes} in use)"
+                )
+                raise _overloaded(503, "Memory budget exhausted")
+            self.in_flight_bytes += extra
+        _reserved_bytes.set(_reserved_bytes.get() + extra)
+        try:
+            yield
+        finally:
+            _reserved_bytes.set(_reserved_bytes.get() - extra)
+            with self._cond:
+                self.in_flight_bytes -= extra
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """Return a snapshot of current usage."""
+        with self._cond:
+            return {
+                "active_jobs": self.active_jobs,
+                "max_jobs": self.max_jobs,
+                "queued_jobs": len(self.admission_queue.waiters),
+                "max_waiting": self.max_waiting,
+                "tenants": {
+                    tenant: {
+                        "active_jobs": self.active_by_tenant[tenant],
+                        "queued_jobs": count - self.active_by_tenant[tenant],
+                        "share": round(self.tenant_share(tenant), 2),
+                    }
+                    for tenant, count in self._tenant_jobs().items()
+                },
+                "in_flight_bytes": self.in_flight_bytes,
+                "max_bytes": self.max_bytes,
+                "stages": {
+                    name: {
+                        "active": self.stage_active[name],
+                        "limit": limit,
+                        "queued": len(self.queues[name].waiters),
+                    }
+                    for name, limit in self.stage_limits.items()
+                },
+                "classes": {
+                    priority: {
+                        "active_jobs": self.active_by_class[priority],
+                        "queued": sum(
+                            queue.depth_by_class()[priority]
+                            for queue in self.queues.values()
+                        ),
+                        **self.wait_stats[priority].to_dict(),
+                    }
+                    for priority in PRIORITIES
+                },
+            }
+
+
+admission = AdmissionController()
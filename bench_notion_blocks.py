@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+import types
+from make_notion_block import NotionBlockMaker
+from notion_blocks import batch_payloads
+
+
+def make_markdown(sections: int) -> str:
+    """Build a summary-shaped markdown document of the given size."""
+    parts = []
+    for i in range(sections):
+        parts.append(f"**Section {i}**")
+        parts.append(
+            "A paragraph of summary text with an equation $E = mc^2$ and some "
+            "more words to make it a realistic length for a Notion block."
+        )
+        parts.extend(f"* Material {j} from supplier {j}" for j in range(4))
+        parts.extend(
+            f"{j}. Step {j} using a furnace at {j * 100} C." for j in range(1, 5)
+        )
+    return "**Abstract**\n" + "\n".join(parts)
+
+
+def baseline_revision() -> str:
+    """The revision just before typed blocks replaced the dict builder."""
+    added = subprocess.run(
+        ["git", "log", "--diff-filter=A", "--format=%H", "--", "notion_blocks.py"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    return f"{added[-1]}^"
+
+
+def load_baseline_maker(revision: str) -> type:
+    """Import NotionBlockMaker from make_notion_block.py at a git revision."""
+    source = subprocess.run(
+        ["git", "show", f"{revision}:make_notion_block.py"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    module = types.ModuleType("baseline_make_notion_block")
+    exec(compile(source, f"{revision}:make_notion_block.py", "exec"), module.__dict__)
+    return module.NotionBlockMaker
+
+
+def dict_path(maker, markdown: str) -> list:
+    """The previous path: nested dicts re-serialised per 100-block chunk."""
+    blocks = maker.build_blocks(markdown)
+    return [
+        json.dumps({"children": blocks[i : i + 100]}).encode("utf-8")
+        for i in range(0, len(blocks), 100)
+    ]
+
+
+def typed_path(maker: NotionBlockMaker, markdown: str) -> list:
+    return batch_payloads(maker.build_blocks(markdown))
+
+
+def measure(fn, maker, markdown, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(maker, markdown)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    fn(maker, markdown)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare dict-of-dicts and typed block serialisation"
+    )
+    parser.add_argument("--sections", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument(
+        "--baseline",
+        help="Git revision of the dict builder (default: before notion_blocks.py)",
+    )
+    args = parser.parse_args()
+
+    revision = args.baseline or baseline_revision()
+    baseline = load_baseline_maker(revision)()
+    maker = NotionBlockMaker()
+    markdown = make_markdown(args.sections)
+    block_count = len(maker.build_blocks(markdown))
+    scale = 1000 / block_count
+
+    print(f"{block_count} blocks per document, figures per 1000 blocks")
+    print(f"  dict builder from {revision}")
+    for name, fn, path_maker in (
+        ("dict + json", dict_path, baseline),
+        ("typed + bytes", typed_path, maker),
+    ):
+        elapsed, peak = measure(fn, path_maker, markdown, args.repeat)
+        print(
+            f"  {name:14} {elapsed * scale * 1000:7.2f} ms  "
+            f"{peak * scale / 1024:8.1f} KiB peak allocated"
+        )
@@ -0,0 +1,228 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from admission import admission
+from make_notion_block import NotionBlockMaker
+from notion_blocks import encode_blocks
+from scheduler import job_context
+from sources import drive_file_id
+from markdown_conversion import (
+    download_document,
+    extract_text,
+    index_document,
+    sha256_file,
+    summarise,
+)
+from text_preprocessing import preprocess_text
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)],
+)
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+# File extensions picked up when a directory is given
+DOCUMENT_EXTENSIONS = (".pdf", ".docx", ".pptx", ".html", ".htm")
+
+
+def collect_sources(inputs: list, urls_file: str = None) -> list:
+    """Expand directories and glob patterns into document paths, and read URLs."""
+    sources = []
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, "**", "*")
+            sources.extend(
+                path
+                for path in sorted(glob.glob(pattern, recursive=True))
+                if path.lower().endswith(DOCUMENT_EXTENSIONS)
+            )
+        else:
+            sources.extend(sorted(glob.glob(item, recursive=True)))
+
+    if urls_file:
+        with open(urls_file) as f:
+            sources.extend(line.strip() for line in f if line.strip())
+
+    # Keep the first occurrence of each source
+    return list(dict.fromkeys(sources))
+
+
+class Manifest:
+    """Record of processed documents in the output directory, keyed by content hash."""
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, sha256: str) -> bool:
+        with self._lock:
+            return sha256 in self.entries
+
+    def add(self, sha256: str, entry: dict):
+        with self._lock:
+            self.entries[sha256] = entry
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def _output_name(source: str, sha256: str) -> str:
+    if source.startswith("https://"):
+        return drive_file_id(source) or sha256[:16]
+    base = os.path.splitext(os.path.basename(source))[0]
+    return f"{base}-{sha256[:8]}"
+
+
+def process_source_as_batch(*args) -> dict:
+    # Worker threads do not inherit the caller's context, so set the class here
+    with job_context("batch", "bulk_convert"):
+        return process_source(*args)
+
+
+def process_source(
+    source: str, output_dir: str, manifest: Manifest, resume: bool
+) -> dict:
+    """
+    Extract, summarise and build Notion blocks for one document
+
+    Returns:
+        dict: The source, its status and the number of bytes read
+    """
+    temp_path = None
+    try:
+        if source.startswith("https://"):
+            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+                temp_path = temp_file.name
+            download_document(source, temp_path)
+            file_path = temp_path
+        else:
+            file_path = source
+
+        sha256 = sha256_file(file_path)
+        size = os.path.getsize(file_path)
+        if resume and sha256 in manifest:
+            logger.info(f"Skipping already processed file: {source}")
+            return {"source": source, "status": "skipped", "bytes": 0}
+
+        raw_text = extract_text(file_path)
+        source_text, token_stats = preprocess_text(raw_text)
+        summary, structured_summary = summarise(source_text)
+        if structured_summary is not None:
+            blocks = NotionBlockMaker().build_blocks_from_summary(structured_summary)
+        else:
+            blocks = NotionBlockMaker().build_blocks(summary)
+
+        name = _output_name(source, sha256)
+        markdown_path = os.path.join(output_dir, f"{name}.md")
+        blocks_path = os.path.join(output_dir, f"{name}.blocks.json")
+        with open(markdown_path, "w", encoding="utf-8") as f:
+            f.write(summary)
+        if blocks is not None:
+            with open(blocks_path, "wb") as f:
+                f.write(encode_blocks(blocks))
+        else:
+            logger.warning(f"Summary for {source} produced no blocks; none written")
+        title = (structured_summary or {}).get("title", "")
+        index_document(
+            sha256, title=title, summary=summary, raw_text=raw_text, source_url=source
+        )
+
+        manifest.add(
+            sha256,
+            {
+                "source": source,
+                "markdown": markdown_path,
+                "blocks": blocks_path if blocks is not None else None,
+                "token_stats": token_stats,
+            },
+        )
+        return {"source": source, "status": "done", "bytes": size}
+
+    except Exception as e:
+        detail = getattr(e, "detail", str(e))
+        logger.error(f"Failed to process {source}: {detail}")
+        return {"source": source, "status": "failed", "bytes": 0}
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Convert a folder of documents to markdown summaries and Notion block JSON"
+    )
+    parser.add_argument(
+        "inputs", nargs="*", help="Directories or glob patterns of local documents"
+    )
+    parser.add_argument(
+        "--urls", help="File with one Google Drive or HTTPS URL per line"
+    )
+    parser.add_argument("-o", "--output", default="output", help="Output directory")
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip files whose content hash is already in the output manifest",
+    )
+    args = parser.parse_args(argv)
+
+    sources = collect_sources(args.inputs, args.urls)
+    if not sources:
+        parser.error("No documents or URLs found")
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(args.output)
+
+    # The service defaults are tuned for a small container; let every worker
+    # run each stage here
+    for stage in admission.stage_limits:
+        admission.stage_limits[stage] = max(admission.stage_limits[stage], args.workers)
+
+    logger.info(f"Processing {len(sources)} sources with {args.workers} workers")
+    start = time.perf_counter()
+    results = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [
+            pool.submit(
+                process_source_as_batch, source, args.output, manifest, args.resume
+            )
+            for source in sources
+        ]
+        for future in as_completed(futures):
+            results.append(future.result())
+    elapsed = time.perf_counter() - start
+
+    counts = {status: 0 for status in ("done", "skipped", "failed")}
+    for result in results:
+        counts[result["status"]] += 1
+    total_mb = sum(result["bytes"] for result in results) / (1024 * 1024)
+
+    print(
+        f"\nProcessed {len(results)} sources in {elapsed:.1f}s: "
+        f"{counts['done']} done, {counts['skipped']} skipped, {counts['failed']} failed"
+    )
+    if elapsed > 0:
+        print(
+            f"Throughput: {counts['done'] / elapsed * 60:.1f} documents/min, "
+            f"{total_mb / elapsed:.2f} MB/s"
+        )
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+from dotenv import load_dotenv
+from notion_blocks import encode_blocks
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Should point at a persistent volume so checkpoints survive container restarts
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", "checkpoints")
+
+# Stages in the order a job completes them
+STAGES = [
+    "queued",
+    "downloaded",
+    "extracted",
+    "summarised",
+    "built",
+    "appended",
+    "properties",
+    "indexed",
+    "linked",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    page_id TEXT NOT NULL,
+    source_url TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    stage TEXT NOT NULL DEFAULT 'queued',
+    pdf_sha256 TEXT,
+    raw_text TEXT,
+    summary TEXT,
+    structured_summary TEXT,
+    token_stats TEXT,
+    api_key TEXT,
+    blocks TEXT,
+    appended_chunks INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class CheckpointStore:
+    """
+    Durable record of each webhook job and the output of every completed stage.
+
+    Every update is committed before the next stage starts, so a job whose
+    status is still 'running' when the process starts again was interrupted
+    and can be resumed from its last completed stage.
+    """
+
+    def __init__(self, directory: str = CHECKPOINT_DIR):
+        self.directory = directory
+        self.files_dir = os.path.join(directory, "files")
+        os.makedirs(self.files_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "jobs.sqlite3"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(_SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Add columns introduced after a store was first created."""
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "structured_summary" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN structured_summary TEXT")
+        if "api_key" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN api_key TEXT")
+        if "token_stats" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN token_stats TEXT")
+
+    def create_job(self, page_id: str, source_url: str, api_key: str = None) -> str:
+        """Record a new job and return its ID. api_key is a key fingerprint."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs"
+                " (job_id, page_id, source_url, api_key, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, page_id, source_url, api_key, now, now),
+            )
+        logger.info(f"Created job {job_id} for page {page_id}")
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for name in ("blocks", "structured_summary", "token_stats"):
+            job[name] = json.loads(job[name]) if job[name] else None
+        return job
+
+    def raw_text(self, job_id: str) -> Optional[str]:
+        """Read back a job's extracted text, which running jobs do not keep in memory."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT raw_text FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return row["raw_text"] if row is not None else None
+
+    def update(self, job_id: str, **fields):
+        """Persist stage output for a job."""
+        if "blocks" in fields and fields["blocks"] is not None:
+            fields["blocks"] = encode_blocks(fields["blocks"]).decode()
+        for name in ("structured_summary", "token_stats"):
+            if fields.get(name) is not None:
+                fields[name] = json.dumps(fields[name])
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET {columns} WHERE job_id = ?",
+                (*fields.values(), job_id),
+            )
+
+    def finish(self, job_id: str, status: str = "done", error: str = None):
+        """Mark a job as finished and drop the intermediate outputs it no longer needs."""
+        self.update(job_id, status=status, error=error, raw_text=None, blocks=None)
+        # A job that failed before extraction leaves its download behind
+        try:
+            os.unlink(self.file_path(job_id))
+        except FileNotFoundError:
+            pass
+        logger.info(f"Job {job_id} finished with status {status}")
+
+    def defer(self, job_id: str, error: str):
+        """Park a job, keeping its checkpoints, until it can be resumed."""
+        self.update(job_id, status="deferred", error=error)
+        logger.info(f"Job {job_id} deferred: {error}")
+
+    def unfinished_jobs(self, status: str = "running") -> list:
+        """Return the IDs of jobs that were interrupted (or deferred) before finishing."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job_id FROM jobs WHERE status = ? ORDER BY created_at",
+                (status,),
+            ).fetchall()
+        return [row["job_id"] for row in rows]
+
+    def file_path(self, job_id: str) -> str:
+        """
+        Path of a job's downloaded file, kept until its text has been extracted.
+
+        Files are keyed by job rather than content hash, so jobs fetching the
+        same document never delete each other's copy.
+        """
+        return os.path.join(self.files_dir, job_id)
+
+
+store = CheckpointStore()
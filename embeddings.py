@@ -0,0 +1,104 @@
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Small CPU-only ONNX model; vectors from different models are not comparable
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+# Characters of extracted text embedded alongside the summary
+EMBED_TEXT_CHARS = int(os.getenv("EMBED_TEXT_CHARS", "4000"))
+# Dimension of the feature-hashing fallback
+HASHING_DIM = 384
+HASHING_MODEL = f"hashing-{HASHING_DIM}"
+# How long to use the fallback before trying to load the model again
+EMBEDDING_RETRY_SECONDS = float(os.getenv("EMBEDDING_RETRY_SECONDS", "300"))
+
+try:
+    from fastembed import TextEmbedding
+except ImportError:
+    TextEmbedding = None
+
+_model = None
+_retry_at = 0.0
+_model_lock = threading.Lock()
+
+_WORD_PATTERN = re.compile(r"[a-z][a-z0-9-]+")
+
+
+def _get_model():
+    """
+    Return the embedding model, or None while only feature hashing is available.
+
+    A failed load, such as a model download interrupted at boot, is retried
+    every EMBEDDING_RETRY_SECONDS rather than for the life of the process.
+    """
+    global _model, _retry_at
+    if _model is not None or TextEmbedding is None:
+        return _model
+    with _model_lock:
+        if _model is None and time.monotonic() >= _retry_at:
+            try:
+                _model = TextEmbedding(model_name=EMBEDDING_MODEL)
+            except Exception as e:
+                _retry_at = time.monotonic() + EMBEDDING_RETRY_SECONDS
+                logger.warning(
+                    f"Could not load embedding model, using feature hashing "
+                    f"for {EMBEDDING_RETRY_SECONDS:.0f}s: {str(e)}"
+                )
+    return _model
+
+
+def _hash_embed(text: str) -> np.ndarray:
+    """Signed feature hashing of word unigrams and bigrams."""
+    vector = np.zeros(HASHING_DIM, dtype=np.float32)
+    words = _WORD_PATTERN.findall(text.lower())
+    for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+        digest = zlib.crc32(feature.encode())
+        vector[digest % HASHING_DIM] += 1.0 if digest & 0x80000000 else -1.0
+    return np.sign(vector) * np.log1p(np.abs(vector))
+
+
+def _normalise(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def embed_texts(texts: list) -> tuple:
+    """
+    Embed each text as a unit-length float32 row.
+
+    Returns:
+        tuple: The rows and the name of the model that produced them
+    """
+    model = _get_model()
+    if model is not None:
+        rows = np.array(list(model.embed(texts)), dtype=np.float32)
+        name = EMBEDDING_MODEL
+    else:
+        rows = np.stack([_hash_embed(text) for text in texts])
+        name = HASHING_MODEL
+    norms = np.linalg.norm(rows, axis=1, keepdims=True)
+    return rows / np.where(norms == 0, 1, norms), name
+
+
+def embed_document(title: str, summary: str, raw_text: str) -> tuple:
+    """
+    Embed a document as the mean of its summary and extracted text vectors.
+
+    Returns:
+        tuple: A unit-length float32 vector and the name of its model
+    """
+    rows, name = embed_texts(
+        [f"{title}\n{summary}".strip(), f"{title}\n{raw_text[:EMBED_TEXT_CHARS]}"]
+    )
+    return _normalise(rows.mean(axis=0)).astype(np.float32), name
@@ -0,0 +1,188 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tracing import CLIENT, span
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_SECONDS = float(os.getenv("HTTP_BACKOFF_SECONDS", "0.5"))
+
+# Statuses that mean the upstream did not act on the request, so even a
+# non-idempotent PATCH or POST can safely be sent again
+REJECTED_STATUSES = (429, 502, 503)
+TRANSIENT_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HttpClient(requests.Session):
+    """
+    A pooled session for one upstream service.
+
+    Connections are kept alive per host in a pool sized to the pipeline
+    stage that uses the client, every request gets a connect and read
+    timeout, and retries follow the client's policy. Requests are counted
+    per host for the /http-pools endpoint, traced as child spans of the
+    current job and carry its W3C traceparent header.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        pool_size: int,
+        retry: Retry,
+        timeout: tuple = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+        pool_hosts: int = 10,
+    ):
+        super().__init__()
+        self.name = name
+        self.timeout = timeout
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.mount("https://", self.adapter)
+        self.mount("http://", self.adapter)
+
+        self._lock = threading.Lock()
+        self._in_flight = defaultdict(int)
+        self._counters = defaultdict(
+            lambda: {"requests": 0, "errors": 0, "retries": 0, "total_seconds": 0.0}
+        )
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlparse(url).hostname
+        with self._lock:
+            self._in_flight[host] += 1
+        start = time.perf_counter()
+        error = False
+        retries = 0
+        try:
+            with span(
+                f"{method} {host}",
+                kind=CLIENT,
+                **{"http.client": self.name, "http.method": method},
+            ) as request_span:
+                if request_span is not None:
+                    kwargs["headers"] = {
+                        **(kwargs.get("headers") or {}),
+                        "traceparent": request_span.traceparent(),
+                    }
+                    data = kwargs.get("data")
+                    if isinstance(data, (bytes, str)):
+                        request_span.set_attributes(**{"http.request.bytes": len(data)})
+                response = super().request(method, url, **kwargs)
+                error = response.status_code >= 400
+                if response.raw is not None and response.raw.retries is not None:
+                    retries = len(response.raw.retries.history)
+                if request_span is not None:
+                    # Streamed bodies have not been read yet, so use the header
+                    response_bytes = response.headers.get("Content-Length")
+                    request_span.set_attributes(
+                        **{
+                            "http.status_code": response.status_code,
+                            "http.retries": retries,
+                            "http.response.bytes": int(response_bytes or 0),
+                        }
+                    )
+                return response
+        except requests.exceptions.RequestException:
+            error = True
+            raise
+        finally:
+            with self._lock:
+                self._in_flight[host] -= 1
+                counters = self._counters[host]
+                counters["requests"] += 1
+                counters["errors"] += error
+                counters["retries"] += retries
+                counters["total_seconds"] += time.perf_counter() - start
+
+    def stats(self) -> dict:
+        """Requests, in-flight calls and pooled connections per host."""
+        pools = {}
+        for pool in list(self.adapter.poolmanager.pools._container.values()):
+            pools[pool.host] = {
+                "connections_opened": pool.num_connections,
+                # Free slots in the pool queue hold None until a connection is returned
+                "idle_connections": (
+                    sum(conn is not None for conn in list(pool.pool.queue))
+                    if pool.pool
+                    else 0
+                ),
+                "max_connections": self.adapter._pool_maxsize,
+            }
+        with self._lock:
+            hosts = set(self._counters) | set(pools)
+            return {
+                host: {
+                    "in_flight": self._in_flight.get(host, 0),
+                    **{
+                        key: round(value, 3)
+                        for key, value in self._counters[host].items()
+                    },
+                    **pools.get(host, {}),
+                }
+                for host in sorted(hosts)
+            }
+
+
+CLIENTS = {}
+
+
+def create_client(
+    name: str,
+    pool_size: int,
+    retry_methods: tuple = ("GET", "HEAD"),
+    retry_statuses: tuple = TRANSIENT_STATUSES,
+    retry_reads: bool = True,
+    timeout: tuple = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+) -> HttpClient:
+    """
+    Create and register a client for one upstream service.
+
+    Args:
+        name: Name shown in pool metrics
+        pool_size: Connections kept per host, normally the stage's concurrency
+        retry_methods: Methods retried on retry_statuses and read errors
+        retry_statuses: Response statuses that are retried with backoff,
+            honouring any Retry-After header
+        retry_reads: Whether a request that timed out or failed after being
+            sent is retried; off for calls that are not safe to repeat
+        timeout: Connect and read timeouts in seconds
+
+    Returns:
+        HttpClient: The registered client
+    """
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        connect=HTTP_MAX_RETRIES,
+        read=HTTP_MAX_RETRIES if retry_reads else 0,
+        status=HTTP_MAX_RETRIES,
+        allowed_methods=frozenset(retry_methods),
+        status_forcelist=retry_statuses,
+        backoff_factor=HTTP_BACKOFF_SECONDS,
+        respect_retry_after_header=True,
+        # Hand the last response back so callers report it as before
+        raise_on_status=False,
+    )
+    client = HttpClient(name, max(1, pool_size), retry, timeout)
+    CLIENTS[name] = client
+    return client
+
+
+def pool_stats() -> dict:
+    """Return per-host metrics for every registered client."""
+    return {name: client.stats() for name, client in CLIENTS.items()}
@@ -0,0 +1,88 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def read_rss_kb(pid: int) -> int:
+    """Read the resident set size of a local process from /proc."""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def sample_rss(pid: int, samples: list, stop: threading.Event, interval: float):
+    while not stop.is_set():
+        try:
+            samples.append(read_rss_kb(pid))
+        except FileNotFoundError:
+            logger.error(f"Process {pid} exited during the load test")
+            return
+        stop.wait(interval)
+
+
+def send_request(url: str, drive_url: str, headers: dict) -> int:
+    try:
+        response = requests.post(url, json={"url": drive_url}, headers=headers)
+        return response.status_code
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request failed: {str(e)}")
+        return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fire a burst of conversions at a local server and track its RSS"
+    )
+    parser.add_argument("drive_url", help="Google Drive URL of a large PDF")
+    parser.add_argument("--url", default="http://localhost:8000/convert-from-url")
+    parser.add_argument("--pid", type=int, help="PID of the server process")
+    parser.add_argument("--burst", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.5)
+    args = parser.parse_args()
+
+    headers = {"access-token": os.getenv("SERVICE_API_KEY")}
+    samples = []
+    stop = threading.Event()
+    sampler = None
+    if args.pid:
+        sampler = threading.Thread(
+            target=sample_rss, args=(args.pid, samples, stop, args.interval)
+        )
+        sampler.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.burst) as pool:
+        statuses = Counter(
+            pool.map(
+                lambda _: send_request(args.url, args.drive_url, headers),
+                range(args.burst),
+            )
+        )
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    if sampler:
+        sampler.join()
+
+    print(f"Sent {args.burst} requests in {elapsed:.1f}s")
+    for status, count in sorted(statuses.items()):
+        print(f"  HTTP {status}: {count}")
+    if samples:
+        print(
+            f"RSS (MiB): start={samples[0] / 1024:.0f} "
+            f"peak={max(samples) / 1024:.0f} end={samples[-1] / 1024:.0f}"
+        )
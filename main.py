@@ -1,44 +1,89 @@
+import hmac
+import json
 import logging
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
 from fastapi.security.api_key import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse
 from markitdown import MarkItDown
 import os
 from pydantic import BaseModel, field_validator
-import re
 import sys
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from markdown_conversion import convert_pdf_to_markdown
-from make_notion_block import NotionBlockMaker
+from accounting import key_fingerprint, ledger, usage_scope
+from admission import admission
+from checkpoints import store
+from http_client import pool_stats
+from profiling import list_profiles, profile_file
+from request_guard import (
+    AUTOMATION_FIELDS,
+    EVENT_FIELDS,
+    MAX_VERIFICATION_BYTES,
+    NOTION_WEBHOOK_SECRET,
+    SIGNATURE_HEADER,
+    SIGNED_KEY,
+    VERIFICATION_KEY,
+    precheck_webhook_body,
+    rate_limiter,
+    read_limited_body,
+    verification_token,
+    verify_signature,
+)
+from pipeline import (
+    parse_webhook_payload,
+    payload_from_event,
+    resume_deferred_jobs,
+    resume_unfinished_jobs,
+    run_job,
+)
+from search_index import search_index
+from sources import drive_file_id, find_fetcher
+from scheduler import DEFAULT_PRIORITY, DEFAULT_TENANT, PRIORITIES, job_context
+from tracing import TraceContextFilter, start_trace
 
 # Load environment variables from .env file
 load_dotenv()
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
-# Configure logging
+# Configure logging. Handlers sit on the root logger so the pipeline
+# modules' logs reach them too, each tagged with its request's trace ID
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
 
 # Create console handler and set level to INFO
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setLevel(logging.INFO)
 
 # Create formatter
-formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+formatter = logging.Formatter(
+    "%(asctime)s - %(levelname)s - [%(trace_id)s] %(name)s - %(message)s"
+)
 console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+console_handler.addFilter(TraceContextFilter())
+root_logger.addHandler(console_handler)
 
 # Add file handler
 file_handler = logging.FileHandler("app.log")
 file_handler.setLevel(logging.INFO)
 file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+file_handler.addFilter(TraceContextFilter())
+root_logger.addHandler(file_handler)
 
-# Prevent duplicate logs
-logger.propagate = False
+# Append every webhook payload to this JSONL file for replay.py
+RECORD_WEBHOOKS_PATH = os.getenv("RECORD_WEBHOOKS_PATH")
+_record_lock = threading.Lock()
 
 API_KEY = os.getenv("SERVICE_API_KEY")
+# Key for the /admin endpoints; defaults to the service key
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY") or API_KEY
 API_KEY_NAME = "access-token"
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 
@@ -55,21 +100,35 @@ class DriveURL(BaseModel):
             logger.error("URL is empty or None")
             raise ValueError("URL cannot be empty")
 
-        file_id_pattern = r"(?:/file/d/|/d/|id=)([a-zA-Z0-9_-]+)"
-        match = re.search(file_id_pattern, url)
-
-        if not match:
-            logger.error(f"Could not extract file ID from URL: {url}")
+        fetcher = find_fetcher(url)
+        if fetcher is None:
+            logger.error(f"No fetcher accepts URL: {url}")
             raise ValueError(
-                "Could not find a valid Google Drive file ID in the URL. Please ensure you're using a valid Google Drive sharing link."
+                "Unsupported URL. Please use a Google Drive sharing link or a direct HTTPS link to the document."
             )
 
-        file_id = match.group(1)
+        if fetcher.name != "drive":
+            return url
+
+        file_id = drive_file_id(url) or url
         logger.info(f"Extracted file ID: {file_id}")
         return file_id
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pick up jobs interrupted by a restart without blocking startup. They
+    # are listed first, so jobs created by new requests are never among them
+    interrupted = store.unfinished_jobs("running")
+    threading.Thread(
+        target=resume_unfinished_jobs, args=("running", interrupted), daemon=True
+    ).start()
+    # Jobs deferred by a daily budget run again when it resets
+    threading.Thread(target=resume_deferred_jobs, daemon=True).start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 origins = [
@@ -88,95 +147,168 @@ app.add_middleware(
 md = MarkItDown()
 
 
+def _key_matches(given: str, expected: str) -> bool:
+    # Constant time, so response timing does not reveal the key
+    return (
+        given is not None
+        and expected is not None
+        and hmac.compare_digest(given.encode(), expected.encode())
+    )
+
+
 async def get_api_key(api_key_header: str = Depends(api_key_header)):
-    if api_key_header == API_KEY:
+    if _key_matches(api_key_header, API_KEY):
         return api_key_header
     else:
         raise HTTPException(status_code=403, detail="Could not validate credentials")
 
 
-@app.post("/convert-from-url")
-async def convert_from_url(drive_url: DriveURL, api_key: str = Depends(get_api_key)):
-    return convert_pdf_to_markdown(drive_url.url)
+async def get_rate_limited_key(api_key: str = Depends(get_api_key)):
+    rate_limiter.check(key_fingerprint(api_key))
+    return api_key
 
 
-@app.post("/notion-webhook")
-async def notion_webhook(request: Request, api_key: str = Depends(get_api_key)):
-    try:
-        payload = await request.json()
-        logger.info(f"Received Notion webhook payload: {payload}")
+async def get_admin_key(api_key_header: str = Depends(api_key_header)):
+    if _key_matches(api_key_header, ADMIN_API_KEY):
+        return api_key_header
+    else:
+        raise HTTPException(status_code=403, detail="Could not validate credentials")
 
-        # Get the page ID from the payload
-        page_id = payload.get("data", {}).get("id")
-        if not page_id:
-            raise HTTPException(
-                status_code=400, detail="No page ID found in the request"
-            )
 
-        logger.info(f"Extracted page ID: {page_id}")
+def _wants_profile(request: Request) -> bool:
+    # "X-Profile: 1" saves a CPU and allocation profile of this request's job
+    return request.headers.get("x-profile", "").lower() in ("1", "true", "yes")
 
-        # Navigate through the JSON structure to find the URL
-        files = (
-            payload.get("data", {})
-            .get("properties", {})
-            .get("File", {})
-            .get("files", [])
-        )
-        if not files:
-            raise HTTPException(status_code=400, detail="No files found in the request")
 
-        # Assuming the first file is the one we want
-        file_info = files[0]
-        drive_url = file_info.get("external", {}).get("url", "").strip(";")
+def _job_priority(request: Request) -> str:
+    # Requests are interactive unless the caller asks for a lower class,
+    # e.g. a backfill script sending "X-Priority: batch"
+    requested = request.headers.get("x-priority", DEFAULT_PRIORITY)
+    return requested if requested in PRIORITIES else DEFAULT_PRIORITY
 
-        if not drive_url:
-            raise HTTPException(
-                status_code=400, detail="No valid URL found in the file information"
-            )
 
-        logger.info(f"Original URL from Notion: {drive_url}")
-
-        # Extract file ID only if it hasn't been processed yet
-        if not drive_url.startswith("https://drive.google.com/uc"):
-            # Extract the file ID and construct a direct download link
-            file_id_match = re.search(r"/file/d/([a-zA-Z0-9_-]+)", drive_url)
-            if file_id_match:
-                file_id = file_id_match.group(1)
-                drive_url = f"https://drive.google.com/uc?id={file_id}"
-                logger.info(f"Processed URL: {drive_url}")
-            else:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Could not extract valid Google Drive file ID from URL",
-                )
+def _record_webhook(request: Request, payload: dict):
+    record = {
+        "received_at": time.time(),
+        "headers": {
+            name: request.headers[name]
+            for name in ("x-priority", "x-workspace-id")
+            if name in request.headers
+        },
+        "payload": payload,
+    }
+    with _record_lock, open(RECORD_WEBHOOKS_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
 
-        # Convert PDF to markdown
-        try:
-            result = convert_pdf_to_markdown(drive_url)
-        except Exception as e:
-            logger.error(f"Error converting PDF: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to convert PDF. Please ensure the Google Drive file is publicly accessible.",
-            )
 
-        if not result or "text_content" not in result:
-            raise HTTPException(
-                status_code=500, detail="Failed to convert PDF to markdown"
-            )
+@app.post("/convert-from-url")
+async def convert_from_url(
+    drive_url: DriveURL, request: Request, api_key: str = Depends(get_rate_limited_key)
+):
+    tenant = request.headers.get("x-workspace-id", DEFAULT_TENANT)
+    with start_trace(
+        "POST /convert-from-url", request.headers.get("traceparent")
+    ) as trace, job_context(_job_priority(request), tenant):
+        async with admission.admit_async():
+            job_id = uuid.uuid4().hex
+            with usage_scope(job_id=job_id, api_key=key_fingerprint(api_key)):
+                result = await run_in_threadpool(
+                    convert_pdf_to_markdown, drive_url.url, _wants_profile(request)
+                )
+            result["usage"] = ledger.job_usage(job_id)
+            result["trace_id"] = trace.trace_id
+            return result
+
+
+async def _verification_handshake(request: Request) -> dict:
+    """
+    Answer the unsigned request Notion sends when a webhook subscription is
+    created. Its token is logged because the operator has to paste it back
+    into Notion, and set it as NOTION_WEBHOOK_SECRET, to verify the endpoint.
+    """
+    rate_limiter.check(VERIFICATION_KEY)
+    token = verification_token(
+        await read_limited_body(request, limit=MAX_VERIFICATION_BYTES)
+    )
+    if token is None:
+        raise HTTPException(status_code=403, detail="Could not validate credentials")
+    logger.warning(
+        f"Received Notion webhook verification token {token}; set it as "
+        f"NOTION_WEBHOOK_SECRET and enter it in Notion to verify the subscription"
+    )
+    return {"status": "verification received"}
 
-        # Create Notion blocks from the markdown content
-        notion_maker = NotionBlockMaker()
-        success = notion_maker.create_blocks_from_markdown(
-            page_id, result["text_content"]
-        )
 
-        if not success:
+@app.post("/notion-webhook")
+async def notion_webhook(request: Request, api_key: str = Depends(api_key_header)):
+    try:
+        # Everything that can be checked without the body is checked first,
+        # so junk traffic is turned away before it is read or parsed. Notion
+        # automations send the access-token header; integration webhooks
+        # sign their events instead
+        signed = False
+        if _key_matches(api_key, API_KEY):
+            job_key = key_fingerprint(api_key)
+            rate_limiter.check(job_key)
+        elif NOTION_WEBHOOK_SECRET and SIGNATURE_HEADER in request.headers:
+            signed = True
+        elif api_key is None and SIGNATURE_HEADER not in request.headers:
+            return await _verification_handshake(request)
+        else:
             raise HTTPException(
-                status_code=500, detail="Failed to create Notion blocks"
+                status_code=403, detail="Could not validate credentials"
             )
 
-        return {"status": "success", "message": "Content added to Notion page"}
+        body = await read_limited_body(request)
+        if signed:
+            if not verify_signature(body, request.headers[SIGNATURE_HEADER]):
+                raise HTTPException(status_code=403, detail="Invalid webhook signature")
+            job_key = SIGNED_KEY
+            rate_limiter.check(job_key)
+        precheck_webhook_body(body, EVENT_FIELDS if signed else AUTOMATION_FIELDS)
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Webhook body is not JSON")
+        if not isinstance(payload, dict):
+            raise HTTPException(status_code=400, detail="Webhook body is not an object")
+
+        workspace_id = request.headers.get("x-workspace-id")
+        if signed:
+            workspace_id = workspace_id or payload.get("workspace_id")
+            # Fetching the page counts against the signed key's usage
+            with usage_scope(api_key=job_key):
+                payload = await run_in_threadpool(payload_from_event, payload)
+            if payload is None:
+                return {"status": "ignored"}
+        if RECORD_WEBHOOKS_PATH:
+            _record_webhook(request, payload)
+
+        page_id, drive_url, database_id = parse_webhook_payload(payload)
+        logger.info(f"Received Notion webhook for page {page_id} ({len(body)} bytes)")
+
+        # Jobs are queued fairly per workspace; Notion automations do not send
+        # a workspace ID, so fall back to the page's parent database
+        tenant = workspace_id if isinstance(workspace_id, str) else database_id
+
+        # Reject early if the pipeline is already full and this workspace has
+        # its share of it. Queueing time is part of the webhook's trace
+        with start_trace(
+            "POST /notion-webhook",
+            request.headers.get("traceparent"),
+            **{"notion.page_id": page_id, "tenant": tenant},
+        ) as trace, job_context(_job_priority(request), tenant):
+            async with admission.admit_async():
+                job_id = store.create_job(page_id, drive_url, job_key)
+                result = await run_in_threadpool(
+                    run_job, job_id, profile=_wants_profile(request)
+                )
+            result["trace_id"] = trace.trace_id
+            # A deferred job is accepted, not refused: it resumes by itself,
+            # so a client retrying a 429 would append the page twice
+            if result["status"] == "deferred":
+                return JSONResponse(status_code=202, content=result)
+            return result
 
     except Exception as e:
         logger.error(f"Error processing Notion webhook: {str(e)}")
@@ -185,6 +317,62 @@ async def notion_webhook(request: Request, api_key: str = Depends(get_api_key)):
         raise HTTPException(status_code=500, detail="Failed to process Notion webhook")
 
 
+@app.get("/queues")
+async def queues(api_key: str = Depends(get_api_key)):
+    """Queue depth and wait time per priority class and stage."""
+    return admission.stats()
+
+
+@app.get("/admin/usage")
+async def usage(
+    days: int = Query(7, ge=1, le=366), api_key: str = Depends(get_admin_key)
+):
+    """Token, download and Notion request totals per day and API key."""
+    return {"days": ledger.daily_totals(days)}
+
+
+@app.get("/admin/usage/jobs/{job_id}")
+async def job_usage(job_id: str, api_key: str = Depends(get_admin_key)):
+    """Usage charged to a single job."""
+    usage = ledger.job_usage(job_id)
+    if usage is None:
+        raise HTTPException(status_code=404, detail="No usage recorded for this job")
+    return usage
+
+
+@app.get("/admin/profiles")
+async def profiles(api_key: str = Depends(get_admin_key)):
+    """Saved job profiles, newest first."""
+    return {"profiles": list_profiles()}
+
+
+@app.get("/admin/profiles/{profile_id}/{name}")
+async def download_profile(
+    profile_id: str, name: str, api_key: str = Depends(get_admin_key)
+):
+    """Download one file of a profile, e.g. cpu.folded for a flame graph."""
+    path = profile_file(profile_id, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile file not found")
+    return FileResponse(path, filename=f"{profile_id}-{name}")
+
+
+@app.get("/http-pools")
+async def http_pools(api_key: str = Depends(get_api_key)):
+    """Connection pool use and request counts per outbound client and host."""
+    return pool_stats()
+
+
+@app.get("/search")
+async def search(
+    q: str = Query(min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    api_key: str = Depends(get_api_key),
+):
+    """Full-text search over every processed document, without calling Notion."""
+    return {"query": q, "results": search_index.search(q, limit)}
+
+
 @app.get("/")
 async def root():
     return {
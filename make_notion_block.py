@@ -1,8 +1,16 @@
 import logging
 import os
-from typing import Dict, Any
-import requests
+import re
+from collections import Counter
+from typing import Callable, List, Optional
 from dotenv import load_dotenv
+from accounting import ledger
+from admission import STAGE_LIMITS
+from http_client import REJECTED_STATUSES, create_client
+from markdown_sections import Section, split_sections
+from notion_blocks import Block, RichText, batch_payloads, text_block
+from structured_summary import SECTION_TITLES, SECTIONS
+from tracing import set_attributes
 
 # Load environment variables
 load_dotenv()
@@ -12,52 +20,72 @@ logger = logging.getLogger(__name__)
 
 NOTION_API_KEY = os.getenv("NOTION_API_KEY")
 NOTION_VERSION = "2022-06-28"  # Current Notion API version
+NOTION_API_URL = os.getenv("NOTION_API_URL", "https://api.notion.com/v1")
+# Build blocks and properties but never write them to Notion
+NOTION_DRY_RUN = os.getenv("NOTION_DRY_RUN", "false").lower() in ("1", "true", "yes")
+
+# Shared by every NotionBlockMaker. Appends are not idempotent, so only
+# requests Notion rejected outright (rate limits, unavailable) are retried
+notion_client = create_client(
+    "notion",
+    pool_size=STAGE_LIMITS["notion"],
+    retry_methods=("GET", "PATCH"),
+    retry_statuses=REJECTED_STATUSES,
+    retry_reads=False,
+)
+
+# Database properties filled from a structured summary; an empty name skips one
+NOTION_TITLE_PROPERTY = os.getenv("NOTION_TITLE_PROPERTY", "Name")
+NOTION_ABSTRACT_PROPERTY = os.getenv("NOTION_ABSTRACT_PROPERTY", "Abstract")
+NOTION_MATERIALS_PROPERTY = os.getenv("NOTION_MATERIALS_PROPERTY", "Materials")
+NOTION_METHODS_PROPERTY = os.getenv("NOTION_METHODS_PROPERTY", "Methods")
+# Notion limits on a single rich text item and a multi-select option name
+MAX_TEXT_LENGTH = 2000
+MAX_OPTION_LENGTH = 100
+MAX_OPTIONS = int(os.getenv("NOTION_MAX_OPTIONS", "10"))
+
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from in into is it of on or the then this "
+    "to was were with using used each all their its after before until "
+    "under over via per".split()
+)
+
+
+def _option_name(text: str) -> str:
+    # Commas are not allowed in multi-select option names
+    return text.replace(",", " ").strip()[:MAX_OPTION_LENGTH].strip()
+
+
+def method_keywords(steps: List[str], limit: int = MAX_OPTIONS) -> List[str]:
+    """Pick the most frequent content words across the method steps."""
+    words = Counter(
+        word
+        for step in steps
+        for word in re.findall(r"[a-z][a-z0-9-]{2,}", step.lower())
+        if word not in _STOPWORDS
+    )
+    return [word for word, _ in words.most_common(limit)]
 
 
 class NotionBlockMaker:
-    def __init__(self):
+    def __init__(self, dry_run: bool = NOTION_DRY_RUN):
+        self.dry_run = dry_run
         self.headers = {
             "Authorization": f"Bearer {NOTION_API_KEY}",
             "Content-Type": "application/json",
             "Notion-Version": NOTION_VERSION,
         }
-        self.base_url = "https://api.notion.com/v1"
+        self.base_url = NOTION_API_URL
 
     def create_blocks_from_markdown(self, page_id: str, markdown_content: str) -> bool:
         """
         Convert markdown content to Notion blocks and append them to the specified page.
         """
         try:
-            logger.info("Starting conversion of markdown to Notion blocks")
-
-            # Find the start of the actual content (from Abstract)
-            content_start = markdown_content.find("**Abstract**")
-            if content_start == -1:
-                content_start = markdown_content.find("Abstract")
-
-            if content_start == -1:
-                logger.error("No Abstract section found in the content")
+            blocks = self.build_blocks(markdown_content)
+            if blocks is None:
                 return False
 
-            logger.info("Found Abstract section, processing content")
-
-            # Only process content from Abstract onwards
-            markdown_content = markdown_content[content_start:]
-
-            # Split content into sections based on headers
-            logger.info("Splitting content into sections")
-            sections = self._split_into_sections(markdown_content)
-            logger.info(f"Found {len(sections)} sections to process")
-
-            # Convert sections to Notion blocks
-            blocks = []
-            for i, section in enumerate(sections, 1):
-                logger.info(f"Processing section {i} of {len(sections)}")
-                section_blocks = self._convert_section_to_blocks(section)
-                blocks.extend(section_blocks)
-
-            logger.info(f"Created {len(blocks)} Notion blocks in total")
-
             # Append blocks to the page
             logger.info(f"Starting to append blocks to Notion page: {page_id}")
             success = self._append_blocks_to_page(page_id, blocks)
@@ -73,21 +101,130 @@ class NotionBlockMaker:
             logger.error(f"Error creating Notion blocks: {str(e)}")
             return False
 
-    def _split_into_sections(self, markdown_content: str) -> list:
-        """Split markdown content into sections based on headers."""
-        sections = []
-        current_section = []
+    def build_blocks(self, markdown_content: str) -> Optional[List[Block]]:
+        """
+        Convert markdown content to a list of Notion blocks without sending them.
+        Returns None if the content produces no blocks at all.
+        """
+        logger.info("Starting conversion of markdown to Notion blocks")
 
-        for line in markdown_content.split("\n"):
-            if line.startswith("**") and "**" in line[2:] and current_section:
-                sections.append("\n".join(current_section))
-                current_section = []
-            current_section.append(line)
+        # Split content into sections based on headers, keeping any preamble
+        sections = split_sections(markdown_content)
+        logger.info(f"Found {len(sections)} sections to process")
 
-        if current_section:
-            sections.append("\n".join(current_section))
+        # Convert sections to Notion blocks
+        blocks = []
+        for section in sections:
+            blocks.extend(self._convert_section_to_blocks(section))
 
-        return sections
+        if not blocks:
+            logger.error("No content found to convert")
+            return None
+
+        logger.info(f"Created {len(blocks)} Notion blocks in total")
+        return blocks
+
+    def build_blocks_from_summary(self, summary: dict) -> List[Block]:
+        """
+        Convert a structured summary straight to Notion blocks, with no text parsing.
+        """
+        blocks = []
+        for name in SECTIONS:
+            blocks.append(self._create_heading_2_block(SECTION_TITLES[name]))
+            value = summary[name]
+            if name == "materials":
+                blocks.extend(self._create_bullet_list_block(item) for item in value)
+            elif name == "methods":
+                blocks.extend(self._create_numbered_list_block(step) for step in value)
+            elif "$" in value:
+                blocks.append(Block("paragraph", self._process_equation_text(value)))
+            else:
+                paragraph_blocks = self._create_paragraph_block(value)
+                if isinstance(paragraph_blocks, list):
+                    blocks.extend(paragraph_blocks)
+                else:
+                    blocks.append(paragraph_blocks)
+
+        logger.info(f"Created {len(blocks)} Notion blocks from structured summary")
+        return blocks
+
+    def build_related_blocks(self, page_ids: List[str]) -> List[Block]:
+        """
+        Build a "Related papers" section of page mentions.
+        """
+        blocks = [self._create_heading_2_block("Related papers")]
+        blocks.extend(
+            Block("bulleted_list_item", [RichText(page_id=page_id)])
+            for page_id in page_ids
+        )
+        return blocks
+
+    def build_page_properties(self, summary: dict) -> dict:
+        """
+        Build the database properties for a page from a structured summary.
+        """
+        properties = {}
+        if NOTION_TITLE_PROPERTY and summary.get("title"):
+            properties[NOTION_TITLE_PROPERTY] = {
+                "title": [RichText(summary["title"][:MAX_TEXT_LENGTH]).to_dict()]
+            }
+        if NOTION_ABSTRACT_PROPERTY:
+            properties[NOTION_ABSTRACT_PROPERTY] = {
+                "rich_text": [RichText(summary["abstract"][:MAX_TEXT_LENGTH]).to_dict()]
+            }
+        if NOTION_MATERIALS_PROPERTY:
+            names = dict.fromkeys(filter(None, map(_option_name, summary["materials"])))
+            properties[NOTION_MATERIALS_PROPERTY] = {
+                "multi_select": [{"name": name} for name in list(names)[:MAX_OPTIONS]]
+            }
+        if NOTION_METHODS_PROPERTY:
+            properties[NOTION_METHODS_PROPERTY] = {
+                "multi_select": [
+                    {"name": name} for name in method_keywords(summary["methods"])
+                ]
+            }
+        return properties
+
+    def get_page(self, page_id: str) -> Optional[dict]:
+        """Fetch a page object, with its properties, or None if that fails."""
+        try:
+            response = notion_client.get(
+                f"{self.base_url}/pages/{page_id}", headers=self.headers
+            )
+            ledger.record(notion_requests=1)
+            if response.status_code != 200:
+                logger.error(f"Failed to fetch page {page_id}: {response.text}")
+                return None
+            return response.json()
+        except Exception as e:
+            logger.error(f"Error fetching page {page_id}: {str(e)}")
+            return None
+
+    def update_page_properties(self, page_id: str, properties: dict) -> bool:
+        """
+        Write database properties to a page in a single request.
+        """
+        if self.dry_run:
+            logger.info(f"Dry run: not updating {len(properties)} properties")
+            return True
+
+        try:
+            url = f"{self.base_url}/pages/{page_id}"
+            logger.info(f"Updating {len(properties)} properties on page {page_id}")
+            response = notion_client.patch(
+                url, headers=self.headers, json={"properties": properties}
+            )
+            ledger.record(notion_requests=1)
+
+            if response.status_code != 200:
+                logger.error(f"Failed to update page properties: {response.text}")
+                return False
+
+            return True
+
+        except Exception as e:
+            logger.error(f"Error updating page properties: {str(e)}")
+            return False
 
     def _split_long_text(self, text: str, limit: int = 2000) -> list:
         """
@@ -145,19 +282,12 @@ class NotionBlockMaker:
             if inline_start == -1:
                 # No more equations, add remaining text
                 if current_pos < len(text):
-                    parts.append(
-                        {"type": "text", "text": {"content": text[current_pos:]}}
-                    )
+                    parts.append(RichText(text[current_pos:]))
                 break
 
             # Add text before equation
             if inline_start > current_pos:
-                parts.append(
-                    {
-                        "type": "text",
-                        "text": {"content": text[current_pos:inline_start]},
-                    }
-                )
+                parts.append(RichText(text[current_pos:inline_start]))
 
             # Check if it's a display equation ($$...$$)
             is_display = text.startswith("$$", inline_start)
@@ -167,51 +297,39 @@ class NotionBlockMaker:
             eq_end = text.find("$$" if is_display else "$", eq_start)
             if eq_end == -1:
                 # Unclosed equation, treat as text
-                parts.append({"type": "text", "text": {"content": text[inline_start:]}})
+                parts.append(RichText(text[inline_start:]))
                 break
 
             # Extract equation content
             equation = text[eq_start:eq_end]
-            parts.append({"type": "equation", "equation": {"expression": equation}})
+            parts.append(RichText(expression=equation))
 
             current_pos = eq_end + (2 if is_display else 1)
 
-        return parts if parts else [{"type": "text", "text": {"content": text}}]
+        return parts if parts else [RichText(text)]
 
-    def _convert_section_to_blocks(self, section: str) -> list:
-        """Convert a markdown section to Notion blocks."""
+    def _convert_section_to_blocks(self, section: Section) -> list:
+        """Convert a section, heading first, to Notion blocks."""
         blocks = []
-        lines = section.split("\n")
+        if section.title is not None:
+            heading_block = {
+                1: self._create_heading_1_block,
+                2: self._create_heading_2_block,
+                3: self._create_heading_3_block,
+            }[section.level]
+            blocks.append(heading_block(section.title))
         was_numbered_list = False
         list_counter = 0  # Track the current number in the list
 
-        for line in lines:
+        for line in section.lines:
             if not line.strip():
                 continue
 
-            # Handle section headers
-            if line.strip().startswith("##"):
-                header_text = line.strip("#").strip()
-                header_text = header_text.replace("*", "").strip()
-                blocks.append(self._create_heading_2_block(header_text))
-                was_numbered_list = False
-                list_counter = 0
-            # Handle subsection headers
-            elif line.strip().startswith("###"):
-                header_text = line.strip("#").strip()
-                header_text = header_text.replace("*", "").strip()
-                blocks.append(self._create_heading_3_block(header_text))
-                was_numbered_list = False
-                list_counter = 0
-            # Handle headers with ** syntax
-            elif line.strip().startswith("**") and line.strip().endswith("**"):
-                header_text = line.strip().strip("*").strip()
-                blocks.append(self._create_heading_2_block(header_text))
-                was_numbered_list = False
-                list_counter = 0
-            # Handle bullet points
-            elif line.strip().startswith("*") and not line.strip().endswith("*"):
-                text = line.strip().lstrip("*").strip()
+            # Handle bullet points, "* item" or "- item"
+            if (
+                line.strip().startswith("*") and not line.strip().endswith("*")
+            ) or line.strip().startswith("- "):
+                text = line.strip()[1:].lstrip("*").strip()
                 text = text.replace("**", "")
                 if was_numbered_list:
                     blocks.append(self._create_bullet_list_block(text, indent=1))
@@ -230,13 +348,7 @@ class NotionBlockMaker:
                 text = line.strip()
                 if "$" in text:
                     rich_text = self._process_equation_text(text)
-                    blocks.append(
-                        {
-                            "object": "block",
-                            "type": "paragraph",
-                            "paragraph": {"rich_text": rich_text},
-                        }
-                    )
+                    blocks.append(Block("paragraph", rich_text))
                 else:
                     text = text.replace("**", "")
                     paragraph_blocks = self._create_paragraph_block(text)
@@ -259,9 +371,7 @@ class NotionBlockMaker:
         while bold_start != -1:
             # Add non-bold text before
             if bold_start > current_pos:
-                parts.append(
-                    {"type": "text", "text": {"content": text[current_pos:bold_start]}}
-                )
+                parts.append(RichText(text[current_pos:bold_start]))
 
             # Find the end of bold text
             bold_end = text.find("**", bold_start + 2)
@@ -269,126 +379,105 @@ class NotionBlockMaker:
                 break
 
             # Add bold text
-            parts.append(
-                {
-                    "type": "text",
-                    "text": {
-                        "content": text[bold_start + 2 : bold_end],
-                        "annotations": {"bold": True},
-                    },
-                }
-            )
+            parts.append(RichText(text[bold_start + 2 : bold_end], bold=True))
 
             current_pos = bold_end + 2
             bold_start = text.find("**", current_pos)
 
         # Add remaining text
         if current_pos < len(text):
-            parts.append({"type": "text", "text": {"content": text[current_pos:]}})
+            parts.append(RichText(text[current_pos:]))
 
-        return parts if parts else [{"type": "text", "text": {"content": text}}]
+        return parts if parts else [RichText(text)]
 
-    def _create_heading_1_block(self, text: str) -> Dict[str, Any]:
+    def _create_heading_1_block(self, text: str) -> Block:
         """Create a heading 1 block."""
-        return {
-            "object": "block",
-            "type": "heading_1",
-            "heading_1": {
-                "rich_text": [{"type": "text", "text": {"content": text.strip()}}]
-            },
-        }
+        return text_block("heading_1", text.strip())
 
-    def _create_heading_2_block(self, text: str) -> Dict[str, Any]:
+    def _create_heading_2_block(self, text: str) -> Block:
         """Create a heading 2 block."""
-        return {
-            "object": "block",
-            "type": "heading_2",
-            "heading_2": {"rich_text": [{"type": "text", "text": {"content": text}}]},
-        }
+        return text_block("heading_2", text)
 
-    def _create_heading_3_block(self, text: str) -> Dict[str, Any]:
+    def _create_heading_3_block(self, text: str) -> Block:
         """Create a heading 3 block."""
-        return {
-            "object": "block",
-            "type": "heading_3",
-            "heading_3": {"rich_text": [{"type": "text", "text": {"content": text}}]},
-        }
+        return text_block("heading_3", text)
 
-    def _create_bullet_list_block(self, text: str, indent: int = 0) -> Dict[str, Any]:
+    def _create_bullet_list_block(self, text: str, indent: int = 0) -> Block:
         """Create a bullet list block."""
-        block = {
-            "object": "block",
-            "type": "bulleted_list_item",
-            "bulleted_list_item": {
-                "rich_text": [{"type": "text", "text": {"content": text}}]
-            },
-        }
+        block = text_block("bulleted_list_item", text)
 
         if indent > 0:
-            block["bulleted_list_item"]["color"] = "default"
-            block["bulleted_list_item"]["children"] = []
+            block.color = "default"
+            block.children = []
 
         return block
 
-    def _create_numbered_list_block(self, text: str) -> Dict[str, Any]:
+    def _create_numbered_list_block(self, text: str) -> Block:
         """Create a numbered list block."""
-        return {
-            "object": "block",
-            "type": "numbered_list_item",
-            "numbered_list_item": {
-                "rich_text": [{"type": "text", "text": {"content": text}}]
-            },
-        }
+        return text_block("numbered_list_item", text)
 
-    def _create_paragraph_block(self, text: str) -> Dict[str, Any]:
+    def _create_paragraph_block(self, text: str):
         """Create a paragraph block, splitting if necessary."""
         # Split text if it exceeds Notion's limit
         text_chunks = self._split_long_text(text)
 
         if len(text_chunks) == 1:
-            return {
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {
-                    "rich_text": [{"type": "text", "text": {"content": text}}]
-                },
-            }
+            return text_block("paragraph", text)
         else:
             # Return list of paragraph blocks for long text
-            return [
-                {
-                    "object": "block",
-                    "type": "paragraph",
-                    "paragraph": {
-                        "rich_text": [{"type": "text", "text": {"content": chunk}}]
-                    },
-                }
-                for chunk in text_chunks
-            ]
+            return [text_block("paragraph", chunk) for chunk in text_chunks]
+
+    def _append_blocks_to_page(
+        self,
+        page_id: str,
+        blocks: list,
+        start_chunk: int = 0,
+        on_chunk: Optional[Callable[[int], None]] = None,
+    ) -> bool:
+        """
+        Append blocks to a Notion page.
 
-    def _append_blocks_to_page(self, page_id: str, blocks: list) -> bool:
-        """Append blocks to a Notion page."""
+        Blocks are serialised once and packed into chunks by block count and
+        byte size. Chunks before start_chunk are assumed to have been sent
+        already, and on_chunk is called with the number of chunks sent after
+        each success.
+        """
         try:
             url = f"{self.base_url}/blocks/{page_id}/children"
 
-            # Notion API has a limit of 100 blocks per request
-            total_chunks = (len(blocks) + 99) // 100  # Round up division
-            for i in range(0, len(blocks), 100):
-                chunk = blocks[i : i + 100]
-                current_chunk = (i // 100) + 1
+            payloads = batch_payloads(blocks)
+            total_chunks = len(payloads)
+            set_attributes(
+                **{
+                    "notion.blocks": len(blocks),
+                    "notion.chunks": total_chunks,
+                    "notion.start_chunk": start_chunk,
+                    "notion.bytes": sum(map(len, payloads[start_chunk:])),
+                }
+            )
+            if self.dry_run:
                 logger.info(
-                    f"Sending chunk {current_chunk} of {total_chunks} to Notion API"
+                    f"Dry run: not sending {total_chunks} chunks "
+                    f"({sum(map(len, payloads))} bytes) to Notion API"
                 )
-
-                response = requests.patch(
-                    url, headers=self.headers, json={"children": chunk}
+                return True
+            for current_chunk in range(start_chunk + 1, total_chunks + 1):
+                payload = payloads[current_chunk - 1]
+                logger.info(
+                    f"Sending chunk {current_chunk} of {total_chunks} "
+                    f"({len(payload)} bytes) to Notion API"
                 )
 
+                response = notion_client.patch(url, headers=self.headers, data=payload)
+                ledger.record(notion_requests=1)
+
                 if response.status_code != 200:
                     logger.error(f"Failed to append blocks: {response.text}")
                     return False
 
                 logger.info(f"Successfully added chunk {current_chunk} to Notion page")
+                if on_chunk:
+                    on_chunk(current_chunk)
 
             return True
 
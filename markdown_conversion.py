@@ -1,246 +1,306 @@
+import hashlib
 import logging
 import tempfile
+import uuid
 import os
-import gdown
 import requests
-import json
-import re
+from contextlib import ExitStack
+from typing import Optional
 from fastapi import HTTPException
 from markitdown import MarkItDown
 from dotenv import load_dotenv
-import io
-from contextlib import redirect_stdout
-import sys
-from tqdm import tqdm
+from accounting import current_scope, ledger
+from admission import admission
+from embeddings import embed_document
+from openrouter import chat_completion
+from profiling import profile_job, profile_stage
+from search_index import search_index
+from structured_summary import summarise_structured, summary_to_markdown
+from sources import detect_converter, fetch_source
+from text_preprocessing import preprocess_text
+from tracing import set_attributes, span
+from vector_index import vector_index
 
 # Load environment variables from .env file
 load_dotenv()
 
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-
 # Configure logging
 logger = logging.getLogger(__name__)
 
 md = MarkItDown()
 
+# "markdown" asks for free-form markdown, "structured" for JSON sections
+SUMMARY_FORMAT = os.getenv("SUMMARY_FORMAT", "markdown")
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_document(source: str, output_path: str, allow_local: bool = False) -> int:
+    """
+    Download a source document and verify it is in a supported format
+
+    Args:
+        source: Google Drive URL or file ID, or any URL a registered fetcher accepts
+        output_path: Path the file is written to
+        allow_local: Whether local file paths may be used as sources
+
+    Returns:
+        int: Size of the downloaded file in bytes
+    """
+    logger.info(f"Downloading file: {source}")
+    logger.info(f"Temporary file path: {output_path}")
+
+    try:
+        fetch_source(source, output_path, allow_local=allow_local)
+
+        logger.info("Download completed successfully")
+
+        # Verify the file exists and has content
+        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+            logger.error("Downloaded file is empty or does not exist")
+            raise HTTPException(
+                status_code=400,
+                detail="Downloaded file is empty or could not be accessed",
+            )
+
+        file_size = os.path.getsize(output_path)
+        logger.info(f"Downloaded file size: {file_size} bytes")
+        ledger.record(download_bytes=file_size)
+        set_attributes(**{"download.bytes": file_size})
+
+        # Sniff the content to check we have a converter for it
+        converter = detect_converter(output_path)
+        if converter is None:
+            raise HTTPException(
+                status_code=400,
+                detail="The downloaded file is not a supported document format",
+            )
+
+        logger.info(f"File download and validation successful ({converter.name})")
+        return file_size
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error during download with requests: {str(e)}")
+        raise HTTPException(
+            status_code=500, detail="Failed to download file using requests"
+        )
+
+
+def extract_text(file_path: str, hold: Optional[ExitStack] = None) -> str:
+    """
+    Extract the raw text of a downloaded file with MarkItDown
+
+    Args:
+        file_path: Path of the downloaded file
+        hold: Keep the extracted text reserved against the byte budget until
+            this stack is closed. The text is reserved before the file's
+            reservation is released, so it is never held unaccounted for
+
+    Returns:
+        str: The extracted text
+    """
+    converter = detect_converter(file_path)
+    if converter is None:
+        raise ValueError("Unsupported document format")
+    logger.info(f"Converting {converter.name} file with MarkItDown")
+
+    # Hold the file size against the memory budget while the file is parsed,
+    # in the extraction pool for its format. The slot is taken first so jobs
+    # queued for it do not tie up budget the running extraction needs
+    with admission.stage(converter.stage), admission.reserve(
+        os.path.getsize(file_path)
+    ):
+        result = md.convert(file_path, file_extension=converter.extension)
+        if not result or not hasattr(result, "text_content"):
+            raise ValueError("Conversion resulted in invalid output")
+        if hold is not None:
+            hold.enter_context(
+                admission.reserve(len(result.text_content), standalone=True)
+            )
+    set_attributes(
+        **{"extract.format": converter.name, "extract.chars": len(result.text_content)}
+    )
+
+    logger.info("Conversion successful")
+    return result.text_content
+
+
+def build_prompt_messages(raw_text: str) -> list:
+    """Build the OpenRouter chat messages asking for a structured summary."""
+    return [
+        {
+            "role": "user",
+            "content": (
+                "You are a helpful assistant.\n\n"
+                "**Task:**\n"
+                "Reorganize the extracted text from a PDF into a clear, concise summary. "
+                "The goal is to provide a succinct overview with short, to-the-point sentences for easy reading. "
+                "Organize the content into the following sections:\n"
+                "1. Abstract: A brief summary of the key objectives, methods, results, and conclusions in 3–4 sentences.\n"
+                "2. Background: A condensed explanation of the context, problem, or research motivation in 2–3 sentences.\n"
+                "3. Methodology:\n"
+                "   - Materials: A brief, bulleted list of key materials and their sources.\n"
+                "   - Methods: A numbered list summarizing the main steps, including key equipment and parameters. Each step should be no more than one sentence.\n"
+                "4. Results: A concise summary of the key findings in 3–4 sentences.\n"
+                "5. Discussion: A brief interpretation of the results and their significance in 3–4 sentences.\n"
+                "6. Conclusion: A short summary of the study's implications and any recommendations in 2–3 sentences.\n\n"
+                "**Formatting Requirements:**\n"
+                "- Use clear section headings (e.g., 'Abstract', 'Background').\n"
+                "- Write in short sentences, avoiding unnecessary detail or repetition.\n"
+                "- Use simple, direct language suitable for a general audience.\n"
+                "- Maintain a professional tone throughout.\n\n"
+                "**Source Text:**\n"
+                f"{raw_text}\n\n"
+                "**Expected Output Format:**\n"
+                "Abstract\n"
+                "- [Condensed abstract text in 3–4 sentences.]\n\n"
+                "Background\n"
+                "- [Condensed background text in 2–3 sentences.]\n\n"
+                "Methodology\n"
+                "Materials:\n"
+                "- [Material 1]\n"
+                "- [Material 2]\n"
+                "\n"
+                "Methods:\n"
+                "1. [Step 1 in one sentence.]\n"
+                "2. [Step 2 in one sentence.]\n"
+                "...\n\n"
+                "Results\n"
+                "- [Key findings in 3–4 sentences.]\n\n"
+                "Discussion\n"
+                "- [Interpretation in 3–4 sentences.]\n\n"
+                "Conclusion\n"
+                "- [Summary in 2–3 sentences.]\n"
+            ),
+        }
+    ]
+
+
+def summarise_text(raw_text: str) -> str:
+    """
+    Restructure extracted text into a sectioned summary with OpenRouter
+
+    Args:
+        raw_text: Source text, normally already passed through preprocess_text
 
-class TqdmToLogger:
+    Returns:
+        str: The markdown summary returned by the model
     """
-    Output stream for TQDM which will output to logger module instead of console.
+    logger.info("Sending request to OpenRouter for cleanup and structuring")
+    cleaned_result = chat_completion(build_prompt_messages(raw_text))
+    logger.info("OpenRouter processing successful")
+    return cleaned_result
+
+
+def summarise(source_text: str) -> tuple:
     """
+    Summarise source text in the configured SUMMARY_FORMAT
 
-    def __init__(self, logger, level=logging.INFO):
-        self.logger = logger
-        self.level = level
-        self.last_msg = ""
+    Returns:
+        tuple: The markdown summary and, in structured mode, the section dict
+    """
+    if SUMMARY_FORMAT == "structured":
+        summary = summarise_structured(source_text)
+        return summary_to_markdown(summary), summary
+    return summarise_text(source_text), None
 
-    def write(self, buf):
-        # Avoid logging empty lines and repeated messages
-        msg = buf.strip()
-        if msg and msg != self.last_msg:
-            self.logger.log(self.level, msg)
-            self.last_msg = msg
 
-    def flush(self):
-        pass
+def index_document(
+    doc_id: str, title: str, summary: str, raw_text: str, source_url: str
+):
+    """
+    Add a converted document to the search index and the vector index
+
+    Args:
+        doc_id: SHA-256 of the source file
+        title: The document's title, or "" if the summary has none
+        summary: The markdown summary
+        raw_text: The full extracted text
+        source_url: Where the document was fetched from
+    """
+    search_index.add_document(
+        doc_id, title=title, summary=summary, body=raw_text, source_url=source_url
+    )
+    with admission.stage("embed"):
+        vector, model = embed_document(title, summary, raw_text)
+    vector_index.add(doc_id, vector, model, title=title)
 
 
-def convert_pdf_to_markdown(drive_url) -> dict:
+def convert_pdf_to_markdown(drive_url, profile: bool = False) -> dict:
     """
-    Convert a PDF file from Google Drive to Markdown
+    Convert a PDF (or other supported document) from Google Drive to Markdown
 
     Args:
-        drive_url: Google Drive URL
+        drive_url: Google Drive URL, or any URL a registered fetcher accepts
+        profile: Save a CPU and allocation profile of the conversion
 
     Returns:
         dict: A dictionary with the converted Markdown text and status
     """
     try:
         # Create a temporary file to save the downloaded content
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
+        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
             temp_path = temp_file.name
-            logger.info(f"Downloading file with ID: {drive_url}")
-            logger.info(f"Temporary file path: {temp_path}")
-
-            try:
-                # Extract file ID from URL if necessary
-                if drive_url.startswith("https://"):
-                    if "id=" in drive_url:
-                        file_id = drive_url.split("id=")[1]
-                    else:
-                        file_id_match = re.search(
-                            r"/file/d/([a-zA-Z0-9_-]+)", drive_url
-                        )
-                        if file_id_match:
-                            file_id = file_id_match.group(1)
-                        else:
-                            raise HTTPException(
-                                status_code=400,
-                                detail="Could not extract valid Google Drive file ID from URL",
-                            )
-                else:
-                    file_id = drive_url
-
-                # Redirect gdown output to logger
-                logger.info(f"Starting download for file ID: {file_id}")
-                tqdm_out = TqdmToLogger(logger)
-                with redirect_stdout(tqdm_out):
-                    output = gdown.download(
-                        id=file_id,
-                        output=temp_path,
-                        quiet=False,
-                    )
-
-                if not output:
-                    logger.error("Download failed")
-                    raise HTTPException(
-                        status_code=400,
-                        detail="Failed to download file from Google Drive",
-                    )
-
-                logger.info("Download completed successfully")
-
-                # Verify the file exists and has content
-                if not os.path.exists(temp_path) or os.path.getsize(temp_path) == 0:
-                    logger.error("Downloaded file is empty or does not exist")
-                    raise HTTPException(
-                        status_code=400,
-                        detail="Downloaded file is empty or could not be accessed",
-                    )
-
-                file_size = os.path.getsize(temp_path)
-                logger.info(f"Downloaded file size: {file_size} bytes")
-
-                # Try to read the first few bytes to verify it's a PDF
-                with open(temp_path, "rb") as f:
-                    header = f.read(4)
-                    if not header.startswith(b"%PDF"):
-                        raise HTTPException(
-                            status_code=400,
-                            detail="The downloaded file is not a valid PDF file",
-                        )
-
-                logger.info("File download and validation successful")
-
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Error during download with requests: {str(e)}")
-                raise HTTPException(
-                    status_code=500, detail="Failed to download file using requests"
-                )
-
-        logger.info("Converting file with MarkItDown")
 
         try:
-            # Convert the file using MarkItDown
-            result = md.convert(temp_path)
-            if not result or not hasattr(result, "text_content"):
-                raise ValueError("Conversion resulted in invalid output")
-
-            logger.info("Conversion successful")
-
-            # The raw extracted text
-            raw_text = result.text_content
-
-            # Now, we use OpenRouter to restructure the text
-            prompt_messages = [
-                {
-                    "role": "user",
-                    "content": (
-                        "You are a helpful assistant.\n\n"
-                        "**Task:**\n"
-                        "Reorganize the extracted text from a PDF into a clear, concise summary. "
-                        "The goal is to provide a succinct overview with short, to-the-point sentences for easy reading. "
-                        "Organize the content into the following sections:\n"
-                        "1. Abstract: A brief summary of the key objectives, methods, results, and conclusions in 3–4 sentences.\n"
-                        "2. Background: A condensed explanation of the context, problem, or research motivation in 2–3 sentences.\n"
-                        "3. Methodology:\n"
-                        "   - Materials: A brief, bulleted list of key materials and their sources.\n"
-                        "   - Methods: A numbered list summarizing the main steps, including key equipment and parameters. Each step should be no more than one sentence.\n"
-                        "4. Results: A concise summary of the key findings in 3–4 sentences.\n"
-                        "5. Discussion: A brief interpretation of the results and their significance in 3–4 sentences.\n"
-                        "6. Conclusion: A short summary of the study's implications and any recommendations in 2–3 sentences.\n\n"
-                        "**Formatting Requirements:**\n"
-                        "- Use clear section headings (e.g., 'Abstract', 'Background').\n"
-                        "- Write in short sentences, avoiding unnecessary detail or repetition.\n"
-                        "- Use simple, direct language suitable for a general audience.\n"
-                        "- Maintain a professional tone throughout.\n\n"
-                        "**Source Text:**\n"
-                        f"{raw_text}\n\n"
-                        "**Expected Output Format:**\n"
-                        "Abstract\n"
-                        "- [Condensed abstract text in 3–4 sentences.]\n\n"
-                        "Background\n"
-                        "- [Condensed background text in 2–3 sentences.]\n\n"
-                        "Methodology\n"
-                        "Materials:\n"
-                        "- [Material 1]\n"
-                        "- [Material 2]\n"
-                        "\n"
-                        "Methods:\n"
-                        "1. [Step 1 in one sentence.]\n"
-                        "2. [Step 2 in one sentence.]\n"
-                        "...\n\n"
-                        "Results\n"
-                        "- [Key findings in 3–4 sentences.]\n\n"
-                        "Discussion\n"
-                        "- [Interpretation in 3–4 sentences.]\n\n"
-                        "Conclusion\n"
-                        "- [Summary in 2–3 sentences.]\n"
-                    ),
-                }
-            ]
-
-            logger.info("Sending request to OpenRouter for cleanup and structuring")
-
-            response = requests.post(
-                url="https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                },
-                data=json.dumps(
-                    {
-                        "model": "google/gemini-2.0-flash-exp:free",
-                        "messages": prompt_messages,
-                    }
-                ),
-            )
+            job_id = current_scope().job_id or uuid.uuid4().hex
+            with profile_job(job_id, profile):
+                # The extracted text counts against the byte budget from
+                # extraction until it has been summarised and indexed
+                with ExitStack() as text_budget:
+                    try:
+                        with span("downloaded"), profile_stage("downloaded"):
+                            download_document(drive_url, temp_path)
+                            sha256 = sha256_file(temp_path)
+                        with span("extracted"), profile_stage("extracted"):
+                            raw_text = extract_text(temp_path, hold=text_budget)
+                    finally:
+                        # Clean up temp file in all cases
+                        try:
+                            os.unlink(temp_path)
+                            logger.info("Temporary file cleaned up")
+                        except Exception as e:
+                            logger.warning(
+                                f"Failed to clean up temporary file: {str(e)}"
+                            )
 
-            if response.status_code != 200:
-                logger.error(
-                    f"OpenRouter API returned an error: {response.status_code} - {response.text}"
-                )
-                raise HTTPException(
-                    status_code=500, detail="Failed to process text with OpenRouter"
-                )
-
-            json_response = response.json()
-
-            if "choices" not in json_response or len(json_response["choices"]) == 0:
-                logger.error("No choices returned from OpenRouter API")
-                raise HTTPException(
-                    status_code=500, detail="OpenRouter returned no valid choices"
-                )
-
-            cleaned_result = json_response["choices"][0]["message"]["content"].strip()
-            if not cleaned_result:
-                logger.error("Cleaned result from OpenRouter is empty")
-                raise HTTPException(
-                    status_code=500, detail="OpenRouter returned an empty result"
-                )
-
-            logger.info("OpenRouter processing successful")
-            return {"text_content": cleaned_result, "status": "success"}
+                    with span("summarised"), profile_stage("summarised"):
+                        source_text, token_stats = preprocess_text(raw_text)
+                        cleaned_result, summary = summarise(source_text)
+                        del source_text
+                    # Indexed like webhook and bulk conversions, so the
+                    # document can be searched and linked as a related paper
+                    with span("indexed"), profile_stage("indexed"):
+                        index_document(
+                            sha256,
+                            title=(summary or {}).get("title", ""),
+                            summary=cleaned_result,
+                            raw_text=raw_text,
+                            source_url=drive_url,
+                        )
+                        del raw_text
+            result = {
+                "text_content": cleaned_result,
+                "status": "success",
+                "token_stats": token_stats,
+            }
+            if summary is not None:
+                result["summary"] = summary
+            return result
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error during conversion: {str(e)}")
             raise HTTPException(status_code=500, detail="Conversion failed")
-        finally:
-            # Clean up temp file in all cases
-            try:
-                os.unlink(temp_path)
-                logger.info("Temporary file cleaned up")
-            except Exception as e:
-                logger.warning(f"Failed to clean up temporary file: {str(e)}")
 
+    except HTTPException:
+        raise
     except ValueError as ve:
         logger.error(f"Validation error: {str(ve)}")
         raise HTTPException(status_code=400, detail=str(ve))
@@ -0,0 +1,104 @@
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional
+from structured_summary import SECTION_TITLES
+
+# "## Methods", "### 2.1 Sample preparation ###"
+_ATX_PATTERN = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+# "**Abstract**", "**Abstract:**", "**Abstract**:"
+_BOLD_PATTERN = re.compile(r"^\*\*([^*]+?)\*\*\s*:?\s*$")
+# Section names models write on a line of their own without any markup
+PLAIN_TITLES = frozenset(
+    title.lower()
+    for title in (
+        *SECTION_TITLES.values(),
+        "Introduction",
+        "Methodology",
+        "Conclusions",
+        "Materials and Methods",
+        "Results and Discussion",
+        "Summary",
+        "Keywords",
+    )
+)
+# Sections the summary prompt nests under another one, e.g. "Materials:" and
+# "Methods:" under "Methodology". Unmarked (bold or plain) headings for them
+# following their parent are given the level below it
+SUBSECTION_TITLES = {"methodology": frozenset({"materials", "methods"})}
+# Bold lines longer than this are emphasised sentences rather than headings
+MAX_BOLD_HEADING_LENGTH = 120
+
+
+@dataclass
+class Section:
+    """A heading and the lines under it, up to the next heading of any level."""
+
+    title: Optional[str]
+    # Notion heading level 1-3, or 0 for text before the first heading
+    level: int
+    lines: List[str] = field(default_factory=list)
+
+
+def parse_heading(line: str) -> Optional[tuple]:
+    """
+    Recognise a heading line.
+
+    Returns:
+        tuple: The Notion heading level and the heading text, or None
+    """
+    stripped = line.strip()
+    match = _ATX_PATTERN.match(stripped)
+    if match:
+        # Notion has three heading levels; deeper ones share the last
+        level = min(len(match.group(1)), 3)
+        return level, match.group(2).replace("*", "").strip()
+
+    match = _BOLD_PATTERN.match(stripped)
+    if match and len(stripped) <= MAX_BOLD_HEADING_LENGTH:
+        return 2, match.group(1).strip().rstrip(":").strip()
+
+    if stripped.rstrip(":").strip().lower() in PLAIN_TITLES:
+        return 2, stripped.rstrip(":").strip()
+
+    return None
+
+
+def split_sections(markdown_content: str) -> List[Section]:
+    """
+    Split markdown into sections in a single pass over its lines.
+
+    ATX (#, ##, ###), bold and plain-title headings all start a new section
+    with the right level. Bold and plain sub-section headings (see
+    SUBSECTION_TITLES) sit one level below their parent. Text before the
+    first heading, such as a title or author line, is kept as a level 0
+    section.
+    """
+    sections = []
+    current = Section(None, 0)
+    # The last heading whose sub-sections may follow, and its level
+    parent = None
+    for line in markdown_content.split("\n"):
+        heading = parse_heading(line)
+        if heading is None:
+            current.lines.append(line)
+            continue
+        if current.title is not None or any(text.strip() for text in current.lines):
+            sections.append(current)
+
+        level, title = heading
+        key = title.lower()
+        if (
+            parent is not None
+            and key in SUBSECTION_TITLES[parent[0]]
+            and not _ATX_PATTERN.match(line.strip())
+        ):
+            level = min(parent[1] + 1, 3)
+        elif key in SUBSECTION_TITLES:
+            parent = (key, level)
+        else:
+            parent = None
+        current = Section(title, level)
+
+    if current.title is not None or any(text.strip() for text in current.lines):
+        sections.append(current)
+    return sections
@@ -0,0 +1,154 @@
+import json
+import os
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Union
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+try:
+    import orjson
+
+    def _dumps(value) -> bytes:
+        return orjson.dumps(value)
+
+except ImportError:
+
+    def _dumps(value) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+# Notion rejects request bodies over 500KB; leave headroom for the envelope
+MAX_PAYLOAD_BYTES = int(os.getenv("NOTION_MAX_PAYLOAD_BYTES", "450000"))
+# Notion API has a limit of 100 blocks per append request
+MAX_BLOCKS_PER_REQUEST = 100
+
+_BOLD = b',"annotations":{"bold":true}'
+
+
+@dataclass(slots=True)
+class RichText:
+    """A text, equation or page mention span inside a block."""
+
+    content: str = ""
+    bold: bool = False
+    expression: Optional[str] = None
+    page_id: Optional[str] = None
+
+    def to_json(self) -> bytes:
+        if self.page_id is not None:
+            return (
+                b'{"type":"mention","mention":{"type":"page","page":{"id":'
+                + _dumps(self.page_id)
+                + b"}}}"
+            )
+        if self.expression is not None:
+            return (
+                b'{"type":"equation","equation":{"expression":'
+                + _dumps(self.expression)
+                + b"}}"
+            )
+        return (
+            b'{"type":"text","text":{"content":'
+            + _dumps(self.content)
+            + b"}"
+            + (_BOLD if self.bold else b"")
+            + b"}"
+        )
+
+    def to_dict(self) -> dict:
+        if self.page_id is not None:
+            return {
+                "type": "mention",
+                "mention": {"type": "page", "page": {"id": self.page_id}},
+            }
+        if self.expression is not None:
+            return {"type": "equation", "equation": {"expression": self.expression}}
+        rich_text = {"type": "text", "text": {"content": self.content}}
+        if self.bold:
+            rich_text["annotations"] = {"bold": True}
+        return rich_text
+
+
+@dataclass(slots=True)
+class Block:
+    """A Notion block that serialises straight to JSON bytes."""
+
+    type: str
+    rich_text: List[RichText]
+    color: Optional[str] = None
+    children: Optional[List["Block"]] = None
+
+    def to_json(self) -> bytes:
+        body = b'{"rich_text":[' + b",".join(rt.to_json() for rt in self.rich_text)
+        body += b"]"
+        if self.color is not None:
+            body += b',"color":' + _dumps(self.color)
+        if self.children is not None:
+            body += b',"children":' + encode_blocks(self.children)
+        block_type = self.type.encode()
+        return (
+            b'{"object":"block","type":"'
+            + block_type
+            + b'","'
+            + block_type
+            + b'":'
+            + body
+            + b"}}"
+        )
+
+    def to_dict(self) -> dict:
+        body = {"rich_text": [rt.to_dict() for rt in self.rich_text]}
+        if self.color is not None:
+            body["color"] = self.color
+        if self.children is not None:
+            body["children"] = [child.to_dict() for child in self.children]
+        return {"object": "block", "type": self.type, self.type: body}
+
+
+def text_block(block_type: str, text: str) -> Block:
+    """Create a block holding a single plain text span."""
+    return Block(block_type, [RichText(text)])
+
+
+def encode_block(block: Union[Block, dict]) -> bytes:
+    """Serialise a block, accepting plain dicts restored from a checkpoint."""
+    if isinstance(block, Block):
+        return block.to_json()
+    return _dumps(block)
+
+
+def encode_blocks(blocks: Iterable[Union[Block, dict]]) -> bytes:
+    """Serialise blocks as a JSON array."""
+    return b"[" + b",".join(encode_block(block) for block in blocks) + b"]"
+
+
+def batch_payloads(
+    blocks: Iterable[Union[Block, dict]],
+    max_blocks: int = MAX_BLOCKS_PER_REQUEST,
+    max_bytes: int = MAX_PAYLOAD_BYTES,
+) -> List[bytes]:
+    """
+    Pack blocks into append-children request bodies.
+
+    Each block is serialised exactly once. A batch is closed when it reaches
+    max_blocks or when the next block would push it past max_bytes.
+    """
+    payloads = []
+    batch = []
+    batch_bytes = 0
+    for block in blocks:
+        encoded = encode_block(block)
+        # +1 for the separating comma
+        if batch and (
+            len(batch) >= max_blocks or batch_bytes + len(encoded) + 1 > max_bytes
+        ):
+            payloads.append(b'{"children":[' + b",".join(batch) + b"]}")
+            batch = []
+            batch_bytes = 0
+        batch.append(encoded)
+        batch_bytes += len(encoded) + 1
+    if batch:
+        payloads.append(b'{"children":[' + b",".join(batch) + b"]}")
+    return payloads
@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from accounting import choose_model, ledger
+from admission import STAGE_LIMITS, admission
+from http_client import HTTP_CONNECT_TIMEOUT, REJECTED_STATUSES, create_client
+from tracing import set_attributes
+
+# Load environment variables from .env file
+load_dotenv()
+
+OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+OPENROUTER_URL = os.getenv(
+    "OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions"
+)
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "google/gemini-2.0-flash-exp:free")
+# Long summaries can take minutes to generate
+OPENROUTER_READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", "300"))
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Completions are billed, so only retry when OpenRouter rejected the request
+client = create_client(
+    "openrouter",
+    pool_size=STAGE_LIMITS["llm"],
+    retry_methods=("POST",),
+    retry_statuses=REJECTED_STATUSES,
+    retry_reads=False,
+    timeout=(HTTP_CONNECT_TIMEOUT, OPENROUTER_READ_TIMEOUT),
+)
+
+
+def chat_completion(messages: list, response_format: dict = None) -> str:
+    """
+    Send a chat completion request to OpenRouter
+
+    Args:
+        messages: Chat messages to send
+        response_format: Optional OpenAI-style response_format, e.g. a JSON schema
+
+    Returns:
+        str: The content of the first choice
+    """
+    # Ask OpenRouter to include the request's cost alongside the token counts
+    body = {
+        "model": choose_model(OPENROUTER_MODEL),
+        "messages": messages,
+        "usage": {"include": True},
+    }
+    if response_format:
+        body["response_format"] = response_format
+    payload = json.dumps(body)
+    del body
+
+    with admission.reserve(len(payload)), admission.stage("llm"):
+        response = client.post(
+            url=OPENROUTER_URL,
+            headers={
+                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+            },
+            data=payload,
+        )
+    del payload
+
+    if response.status_code != 200:
+        logger.error(
+            f"OpenRouter API returned an error: {response.status_code} - {response.text}"
+        )
+        raise HTTPException(
+            status_code=500, detail="Failed to process text with OpenRouter"
+        )
+
+    json_response = response.json()
+    usage = json_response.get("usage") or {}
+    ledger.record(
+        llm_requests=1,
+        prompt_tokens=usage.get("prompt_tokens", 0),
+        completion_tokens=usage.get("completion_tokens", 0),
+        cost=usage.get("cost", 0.0),
+    )
+    set_attributes(
+        **{
+            "llm.model": json_response.get("model") or OPENROUTER_MODEL,
+            "llm.prompt_tokens": usage.get("prompt_tokens", 0),
+            "llm.completion_tokens": usage.get("completion_tokens", 0),
+        }
+    )
+
+    if "choices" not in json_response or len(json_response["choices"]) == 0:
+        logger.error("No choices returned from OpenRouter API")
+        raise HTTPException(
+            status_code=500, detail="OpenRouter returned no valid choices"
+        )
+
+    content = json_response["choices"][0]["message"]["content"].strip()
+    if not content:
+        logger.error("Cleaned result from OpenRouter is empty")
+        raise HTTPException(
+            status_code=500, detail="OpenRouter returned an empty result"
+        )
+
+    return content
@@ -0,0 +1,488 @@
+import logging
+import os
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Optional
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from accounting import (
+    BudgetExceeded,
+    check_notion_budget,
+    seconds_until_reset,
+    usage_scope,
+)
+from admission import RETRY_AFTER_SECONDS, admission
+from checkpoints import STAGES, store
+from scheduler import DEFAULT_TENANT, job_context
+from make_notion_block import NotionBlockMaker
+from profiling import profile_job, profile_stage
+from markdown_conversion import (
+    download_document,
+    extract_text,
+    sha256_file,
+    summarise,
+)
+from embeddings import EMBED_TEXT_CHARS, embed_document
+from search_index import search_index
+from sources import find_fetcher
+from vector_index import vector_index
+from text_preprocessing import preprocess_text
+from tracing import INTERNAL, set_attributes, span, start_trace
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Copy key summary fields into the page's database properties
+WRITE_NOTION_PROPERTIES = os.getenv("WRITE_NOTION_PROPERTIES", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+# Related papers appended to each page; 0 only adds the document to the index
+RELATED_PAPERS_K = int(os.getenv("RELATED_PAPERS_K", "0"))
+# Neighbours less similar than this are not worth linking
+MIN_RELATED_SIMILARITY = float(os.getenv("MIN_RELATED_SIMILARITY", "0.5"))
+
+# One instance for every job; its HTTP client is shared and pooled
+notion_maker = NotionBlockMaker()
+
+# Signed integration events that may mean a page has a new file to process
+NOTION_PAGE_EVENTS = ("page.created", "page.properties_updated")
+
+
+def _object(value) -> dict:
+    # Payloads are untrusted; a nested value of the wrong type reads as empty
+    return value if isinstance(value, dict) else {}
+
+
+def parse_webhook_payload(payload: dict) -> tuple:
+    """
+    Pull the page, source file URL and parent database out of a Notion webhook.
+
+    Returns:
+        tuple: The page ID, source URL and parent database ID (DEFAULT_TENANT
+        when the page has no parent database)
+
+    Raises:
+        HTTPException: 400 if the payload has no page ID or supported file URL
+    """
+    # Get the page ID from the payload
+    data = _object(_object(payload).get("data"))
+    page_id = data.get("id")
+    if not page_id or not isinstance(page_id, str):
+        raise HTTPException(status_code=400, detail="No page ID found in the request")
+
+    logger.info(f"Extracted page ID: {page_id}")
+
+    # Navigate through the JSON structure to find the URL
+    files = _object(_object(data.get("properties")).get("File")).get("files")
+    if not files or not isinstance(files, list):
+        raise HTTPException(status_code=400, detail="No files found in the request")
+
+    # Assuming the first file is the one we want. Links are "external"
+    # files, uploads are Notion-hosted "file" entries
+    file_info = _object(files[0])
+    file_type = file_info.get("type", "external")
+    source_url = _object(file_info.get(file_type)).get("url")
+
+    if not source_url or not isinstance(source_url, str):
+        raise HTTPException(
+            status_code=400, detail="No valid URL found in the file information"
+        )
+    source_url = source_url.strip(";")
+
+    logger.info(f"Original URL from Notion: {source_url}")
+
+    fetcher = find_fetcher(source_url)
+    if fetcher is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Could not find a supported source URL in the file information",
+        )
+    logger.info(f"Using {fetcher.name} fetcher for URL")
+
+    database_id = _object(data.get("parent")).get("database_id") or DEFAULT_TENANT
+    return page_id, source_url, str(database_id)
+
+
+def payload_from_event(event: dict) -> Optional[dict]:
+    """
+    Turn a signed Notion integration event into an automation-style payload.
+
+    Events only name the page, so the page is fetched for its File property.
+    Only page creation and File changes start a job; other events, including
+    the property and content updates a job makes itself, are ignored. So are
+    pages without a usable File entry: Notion redelivers events that are not
+    answered with a 2xx, and each redelivery would fetch the page again.
+
+    Returns:
+        dict: A payload for parse_webhook_payload, or None to ignore the event
+
+    Raises:
+        HTTPException: 400 if the event names no page, 502 if it cannot be fetched
+    """
+    event_type = event.get("type")
+    if event_type not in NOTION_PAGE_EVENTS:
+        logger.info(f"Ignoring Notion event of type {event_type}")
+        return None
+    entity = _object(event.get("entity"))
+    page_id = entity.get("id")
+    if entity.get("type") != "page" or not page_id or not isinstance(page_id, str):
+        raise HTTPException(status_code=400, detail="Event does not name a page")
+
+    page = notion_maker.get_page(page_id)
+    if page is None:
+        raise HTTPException(status_code=502, detail="Could not fetch the Notion page")
+
+    if event_type == "page.properties_updated":
+        file_property = _object(_object(page.get("properties")).get("File"))
+        updated = _object(event.get("data")).get("updated_properties") or []
+        if file_property.get("id") not in updated:
+            logger.info(f"Ignoring property update on page {page_id}: File unchanged")
+            return None
+
+    payload = {"data": page}
+    try:
+        parse_webhook_payload(payload)
+    except HTTPException as e:
+        logger.info(f"Ignoring {event_type} event on page {page_id}: {e.detail}")
+        return None
+    return payload
+
+
+def _download(job: dict, allow_local: bool = False):
+    """Download the source file into the checkpoint directory and record its hash."""
+    fd, part_path = tempfile.mkstemp(suffix=".part", dir=store.files_dir)
+    os.close(fd)
+    try:
+        download_document(job["source_url"], part_path, allow_local=allow_local)
+        sha256 = sha256_file(part_path)
+        os.replace(part_path, store.file_path(job["job_id"]))
+    finally:
+        if os.path.exists(part_path):
+            os.unlink(part_path)
+    store.update(job["job_id"], pdf_sha256=sha256, stage="downloaded")
+    job.update(pdf_sha256=sha256, stage="downloaded")
+
+
+def _extract(job: dict, text_budget: ExitStack):
+    file_path = store.file_path(job["job_id"])
+    raw_text = extract_text(file_path, hold=text_budget)
+    store.update(job["job_id"], raw_text=raw_text, stage="extracted")
+    job.update(raw_text=raw_text, stage="extracted")
+    try:
+        os.unlink(file_path)
+    except OSError as e:
+        logger.warning(f"Failed to clean up downloaded file: {str(e)}")
+
+
+def _summarise(job: dict):
+    source_text, token_stats = preprocess_text(job["raw_text"])
+    summary, structured_summary = summarise(source_text)
+    store.update(
+        job["job_id"],
+        summary=summary,
+        structured_summary=structured_summary,
+        token_stats=token_stats,
+        stage="summarised",
+    )
+    job.update(
+        summary=summary,
+        structured_summary=structured_summary,
+        token_stats=token_stats,
+        stage="summarised",
+    )
+
+
+def _title(job: dict) -> str:
+    return (job["structured_summary"] or {}).get("title", "")
+
+
+def _write_properties(job: dict):
+    """Copy the title, abstract, materials and method keywords onto the page."""
+    if job["structured_summary"] is None:
+        logger.info("Skipping page properties: no structured summary")
+        return
+    properties = notion_maker.build_page_properties(job["structured_summary"])
+    with admission.stage("notion"):
+        success = notion_maker.update_page_properties(job["page_id"], properties)
+    if not success:
+        raise HTTPException(
+            status_code=500, detail="Failed to update Notion page properties"
+        )
+
+
+def _link_related(job: dict):
+    """Add the document to the vector index and link its nearest neighbours."""
+    with admission.stage("embed"):
+        vector, model = embed_document(
+            _title(job), job["summary"], store.raw_text(job["job_id"]) or ""
+        )
+    added = vector_index.add(
+        job["pdf_sha256"],
+        vector,
+        model,
+        page_id=job["page_id"],
+        title=_title(job),
+    )
+    if RELATED_PAPERS_K <= 0 or not added:
+        return
+
+    neighbours = vector_index.search(
+        vector,
+        model,
+        RELATED_PAPERS_K,
+        exclude=job["pdf_sha256"],
+        linkable_only=True,
+    )
+    page_ids = list(
+        dict.fromkeys(
+            n["page_id"]
+            for n in neighbours
+            if n["score"] >= MIN_RELATED_SIMILARITY and n["page_id"] != job["page_id"]
+        )
+    )
+    if not page_ids:
+        logger.info("No related papers similar enough to link")
+        return
+
+    check_notion_budget()
+    logger.info(f"Linking {len(page_ids)} related papers on page {job['page_id']}")
+    with admission.stage("notion"):
+        success = notion_maker._append_blocks_to_page(
+            job["page_id"], notion_maker.build_related_blocks(page_ids)
+        )
+    if not success:
+        raise HTTPException(status_code=500, detail="Failed to link related papers")
+
+
+def _done(job: dict, stage: str) -> bool:
+    return STAGES.index(job["stage"]) >= STAGES.index(stage)
+
+
+@contextmanager
+def _timed(stage: str, on_stage: Optional[Callable[[str, float], None]]):
+    start = time.perf_counter()
+    with span(stage), profile_stage(stage):
+        yield
+    if on_stage:
+        on_stage(stage, time.perf_counter() - start)
+
+
+def run_job(
+    job_id: str,
+    allow_local: bool = False,
+    on_stage: Optional[Callable[[str, float], None]] = None,
+    profile: bool = False,
+) -> dict:
+    """
+    Run a webhook job to completion, skipping every stage already checkpointed.
+
+    Args:
+        job_id: ID of a job created with store.create_job
+        allow_local: Whether the job's source may be a local file path
+        on_stage: Called with each stage's name and duration in seconds as
+            it completes, e.g. by the replay tool
+        profile: Save a CPU and allocation profile of the job (see profiling)
+
+    Returns:
+        dict: The job's status, "success" or "deferred" when a daily budget
+        ran out. Deferred jobs resume on their own once the budget resets,
+        so callers must not submit them again. A successful job also
+        reports the token_stats of its source text's preprocessing.
+
+    Raises:
+        HTTPException: If any stage fails. The job is then marked as failed.
+    """
+    job = store.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    logger.info(f"Running job {job_id} from stage '{job['stage']}'")
+    set_attributes(
+        **{"job.id": job_id, "job.page_id": job["page_id"], "job.stage": job["stage"]}
+    )
+    if job["status"] == "deferred":
+        store.update(job_id, status="running")
+
+    # Usage is charged to the job and the API key that submitted it
+    scope = usage_scope(job_id=job_id, api_key=job["api_key"])
+    with scope, profile_job(job_id, profile):
+
+        try:
+            try:
+                # A restart between download and extraction may have lost the file
+                if not _done(job, "downloaded") or (
+                    not _done(job, "extracted")
+                    and not os.path.exists(store.file_path(job_id))
+                ):
+                    with _timed("downloaded", on_stage):
+                        _download(job, allow_local)
+                # The extracted text counts against the byte budget from
+                # extraction until it has been summarised
+                with ExitStack() as text_budget:
+                    if not _done(job, "extracted"):
+                        with _timed("extracted", on_stage):
+                            _extract(job, text_budget)
+                    elif not _done(job, "summarised"):
+                        text_budget.enter_context(
+                            admission.reserve(len(job["raw_text"]))
+                        )
+                    if not _done(job, "summarised"):
+                        with _timed("summarised", on_stage):
+                            _summarise(job)
+                # Later stages read the text back from the checkpoint when
+                # they need it, instead of holding it through the Notion calls
+                job.pop("raw_text", None)
+            except Exception as e:
+                # Overload and size limits are surfaced to the caller as-is
+                if isinstance(e, HTTPException) and e.status_code in (413, 429, 503):
+                    raise e
+                logger.error(f"Error converting PDF: {str(e)}")
+                raise HTTPException(
+                    status_code=500,
+                    detail="Failed to convert PDF. Please ensure the Google Drive file is publicly accessible.",
+                )
+
+            if not _done(job, "built"):
+                with _timed("built", on_stage):
+                    if job["structured_summary"] is not None:
+                        blocks = notion_maker.build_blocks_from_summary(
+                            job["structured_summary"]
+                        )
+                    else:
+                        blocks = notion_maker.build_blocks(job["summary"])
+                    if blocks is None:
+                        raise HTTPException(
+                            status_code=500, detail="Failed to create Notion blocks"
+                        )
+                    store.update(job_id, blocks=blocks, stage="built")
+                    job.update(blocks=blocks, stage="built")
+
+            if not _done(job, "appended"):
+                check_notion_budget()
+                with _timed("appended", on_stage):
+                    logger.info(
+                        f"Appending blocks to Notion page {job['page_id']} "
+                        f"from chunk {job['appended_chunks'] + 1}"
+                    )
+                    with admission.stage("notion"):
+                        success = notion_maker._append_blocks_to_page(
+                            job["page_id"],
+                            job["blocks"],
+                            start_chunk=job["appended_chunks"],
+                            on_chunk=lambda n: store.update(job_id, appended_chunks=n),
+                        )
+                    if not success:
+                        raise HTTPException(
+                            status_code=500, detail="Failed to create Notion blocks"
+                        )
+                    store.update(job_id, stage="appended")
+                    job.update(stage="appended")
+
+            if not _done(job, "properties"):
+                with _timed("properties", on_stage):
+                    if WRITE_NOTION_PROPERTIES:
+                        check_notion_budget()
+                        _write_properties(job)
+                    store.update(job_id, stage="properties")
+                    job.update(stage="properties")
+
+            # Index before finishing, which drops the extracted text. Only
+            # the part that is embedded is kept for linking
+            if not _done(job, "indexed"):
+                with _timed("indexed", on_stage):
+                    body = store.raw_text(job_id) or ""
+                    search_index.add_document(
+                        job["pdf_sha256"],
+                        title=_title(job),
+                        summary=job["summary"],
+                        body=body,
+                        page_id=job["page_id"],
+                        source_url=job["source_url"],
+                    )
+                    store.update(
+                        job_id, raw_text=body[:EMBED_TEXT_CHARS], stage="indexed"
+                    )
+                    del body
+                    job.update(stage="indexed")
+
+            if not _done(job, "linked"):
+                with _timed("linked", on_stage):
+                    _link_related(job)
+                    store.update(job_id, stage="linked")
+
+        except BudgetExceeded as e:
+            # Picked up again by resume_deferred_jobs once the budget resets
+            store.defer(job_id, e.reason)
+            return {
+                "status": "deferred",
+                "job_id": job_id,
+                "message": (
+                    f"{e.reason}; the job will resume automatically "
+                    f"in about {e.retry_after} seconds"
+                ),
+            }
+        except Exception as e:
+            store.finish(job_id, status="failed", error=str(e))
+            raise
+
+        store.finish(job_id)
+        return {
+            "status": "success",
+            "job_id": job_id,
+            "message": "Content added to Notion page",
+            "token_stats": job["token_stats"],
+        }
+
+
+def resume_unfinished_jobs(status: str = "running", job_ids: list = None):
+    """
+    Resume jobs interrupted by a restart (or deferred), one at a time.
+
+    Args:
+        status: Status of the jobs to resume
+        job_ids: The jobs to resume, if already listed. Interrupted jobs must
+            be listed before the service accepts requests, or a job created
+            by a request could be run a second time here
+    """
+    if job_ids is None:
+        job_ids = store.unfinished_jobs(status)
+    if not job_ids:
+        return
+    logger.info(f"Resuming {len(job_ids)} {status} jobs")
+    for job_id in job_ids:
+        while True:
+            admitted = False
+            try:
+                with start_trace(f"resume {status} job", kind=INTERNAL), job_context(
+                    "background"
+                ), admission.admit():
+                    admitted = True
+                    run_job(job_id)
+            except Exception as e:
+                if not admitted:
+                    # The job has not started, so it would otherwise stay in
+                    # its status until the next restart
+                    logger.warning(
+                        f"No slot to resume job {job_id}; "
+                        f"retrying in {RETRY_AFTER_SECONDS} seconds"
+                    )
+                    time.sleep(RETRY_AFTER_SECONDS)
+                    continue
+                logger.error(f"Failed to resume job {job_id}: {str(e)}")
+            break
+
+
+def resume_deferred_jobs():
+    """
+    Resume jobs deferred by a daily budget, at startup in case the budgets
+    reset while the service was down, and then each time they reset.
+    """
+    resume_unfinished_jobs("deferred")
+    while True:
+        time.sleep(seconds_until_reset())
+        resume_unfinished_jobs("deferred")
@@ -0,0 +1,218 @@
+import contextvars
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+from dotenv import load_dotenv
+from checkpoints import CHECKPOINT_DIR
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(CHECKPOINT_DIR, "profiles"))
+# Keep a CPU profile of every job slower than this; 0 only profiles on request
+PROFILE_SLOW_JOB_SECONDS = float(os.getenv("PROFILE_SLOW_JOB_SECONDS", "0"))
+# tracemalloc slows every allocation in the process, so jobs profiled only
+# because they might be slow skip it unless this is set
+PROFILE_SLOW_JOB_ALLOCATIONS = os.getenv(
+    "PROFILE_SLOW_JOB_ALLOCATIONS", "false"
+).lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+# Stages that do their work in Python rather than waiting on an upstream
+CPU_STAGES = ("extracted", "built")
+TOP_ALLOCATIONS = 50
+
+_PROFILE_ID_PATTERN = re.compile(r"[0-9a-f]+-\d+")
+
+_current_profiler = contextvars.ContextVar("current_profiler", default=None)
+
+# tracemalloc is process wide; it runs while any profiled job is in a CPU stage
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)})"
+
+
+class JobProfiler:
+    """
+    Samples one job's thread and snapshots its allocations.
+
+    A background thread reads the job thread's current stack every
+    PROFILE_SAMPLE_INTERVAL seconds and counts it under the running stage,
+    so time spent waiting on I/O shows up next to time spent computing.
+    Counts are written in the collapsed format flamegraph tools read.
+    Allocation snapshots are process wide and include any job running
+    alongside this one.
+    """
+
+    def __init__(self, job_id: str, allocations: bool):
+        self.profile_id = f"{job_id}-{int(time.time())}"
+        self.job_id = job_id
+        self.allocations = allocations
+        self.directory = os.path.join(PROFILE_DIR, self.profile_id)
+        self.stage = "setup"
+        self.stage_seconds = {}
+        self.samples = Counter()
+        self.snapshots = {}
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            stack.append(self.stage)
+            self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._sampler.start()
+
+    @contextmanager
+    def stage_scope(self, stage: str):
+        self.stage = stage
+        trace = self.allocations and stage in CPU_STAGES
+        if trace:
+            _start_tracemalloc()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[stage] = time.perf_counter() - start
+            if trace:
+                self.snapshots[stage] = tracemalloc.take_snapshot()
+                _stop_tracemalloc()
+            self.stage = "between stages"
+
+    def stop(self) -> float:
+        self._stop.set()
+        self._sampler.join()
+        return time.perf_counter() - self.start_time
+
+    def save(self, seconds: float, reason: str):
+        """Write the collapsed stacks, allocation reports and a summary."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "cpu.folded"), "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        for stage, snapshot in self.snapshots.items():
+            snapshot.dump(os.path.join(self.directory, f"allocations-{stage}.snapshot"))
+            with open(
+                os.path.join(self.directory, f"allocations-{stage}.txt"), "w"
+            ) as f:
+                for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    f.write(f"{stat}\n")
+        with open(os.path.join(self.directory, "profile.json"), "w") as f:
+            json.dump(
+                {
+                    "profile_id": self.profile_id,
+                    "job_id": self.job_id,
+                    "reason": reason,
+                    "seconds": round(seconds, 3),
+                    "stage_seconds": {
+                        stage: round(value, 3)
+                        for stage, value in self.stage_seconds.items()
+                    },
+                    "samples": sum(self.samples.values()),
+                    "sample_interval": PROFILE_SAMPLE_INTERVAL,
+                },
+                f,
+                indent=2,
+            )
+        logger.info(f"Saved profile {self.profile_id} ({reason})")
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            tracemalloc.start()
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+@contextmanager
+def profile_job(job_id: str, requested: bool = False):
+    """
+    Profile the enclosed job if it was requested, or keep the profile if the
+    job turns out slower than PROFILE_SLOW_JOB_SECONDS.
+    """
+    if not requested and not PROFILE_SLOW_JOB_SECONDS:
+        yield None
+        return
+
+    profiler = JobProfiler(job_id, requested or PROFILE_SLOW_JOB_ALLOCATIONS)
+    token = _current_profiler.set(profiler)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        _current_profiler.reset(token)
+        seconds = profiler.stop()
+        if requested:
+            profiler.save(seconds, "requested")
+        elif seconds >= PROFILE_SLOW_JOB_SECONDS:
+            profiler.save(seconds, f"slower than {PROFILE_SLOW_JOB_SECONDS}s")
+
+
+@contextmanager
+def profile_stage(stage: str):
+    """Label samples, and trace allocations in CPU stages, for a profiled job."""
+    profiler = _current_profiler.get()
+    if profiler is None:
+        yield
+        return
+    with profiler.stage_scope(stage):
+        yield
+
+
+def list_profiles() -> list:
+    """Summaries of every saved profile, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for profile_id in os.listdir(PROFILE_DIR):
+        summary_path = os.path.join(PROFILE_DIR, profile_id, "profile.json")
+        if not os.path.exists(summary_path):
+            continue
+        with open(summary_path) as f:
+            summary = json.load(f)
+        summary["files"] = sorted(os.listdir(os.path.dirname(summary_path)))
+        profiles.append(summary)
+    return sorted(
+        profiles, key=lambda p: int(p["profile_id"].rsplit("-", 1)[1]), reverse=True
+    )
+
+
+def profile_file(profile_id: str, name: str) -> Optional[str]:
+    """Path of a file in a saved profile, or None if there is no such file."""
+    if not _PROFILE_ID_PATTERN.fullmatch(profile_id):
+        return None
+    directory = os.path.join(PROFILE_DIR, profile_id)
+    if not os.path.isdir(directory) or name not in os.listdir(directory):
+        return None
+    return os.path.join(directory, name)
@@ -0,0 +1,263 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler(sys.stdout)],
+)
+logger = logging.getLogger(__name__)
+
+STAND_IN_MARKDOWN = "\n\n".join(
+    f"**{title}**\nStand-in {title.lower()} text."
+    for title in (
+        "Abstract",
+        "Background",
+        "Materials",
+        "Methods",
+        "Results",
+        "Discussion",
+        "Conclusion",
+    )
+)
+
+
+def load_records(paths: list) -> list:
+    """
+    Read recorded webhooks from JSONL files.
+
+    Lines may be records written with RECORD_WEBHOOKS_PATH, or bare
+    /notion-webhook payloads.
+    """
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "payload" not in record:
+                    record = {"payload": record}
+                records.append(record)
+    return records
+
+
+def _stand_in_reply(body: dict) -> dict:
+    """An OpenRouter-shaped reply, honouring a JSON schema response_format."""
+    response_format = body.get("response_format")
+    if response_format:
+        schema = response_format["json_schema"]["schema"]
+        content = json.dumps(
+            {
+                name: (
+                    [f"Stand-in {name} item."]
+                    if prop.get("type") == "array"
+                    else f"Stand-in {name} text."
+                )
+                for name, prop in schema["properties"].items()
+            }
+        )
+    else:
+        content = STAND_IN_MARKDOWN
+    prompt = json.dumps(body.get("messages", []))
+    return {
+        "choices": [{"message": {"content": content}}],
+        # Roughly four characters per token, like text_preprocessing's fallback
+        "usage": {
+            "prompt_tokens": len(prompt) // 4,
+            "completion_tokens": len(content) // 4,
+        },
+    }
+
+
+def start_stand_ins(llm_latency: float, notion_latency: float) -> ThreadingHTTPServer:
+    """Serve local stand-ins for OpenRouter and the Notion API on a free port."""
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, latency: float, body: dict):
+            time.sleep(latency)
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_body(self) -> dict:
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_POST(self):
+            self._reply(llm_latency, _stand_in_reply(self._read_body()))
+
+        def do_PATCH(self):
+            self._read_body()
+            self._reply(notion_latency, {"object": "list", "results": []})
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(values) - 1, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def print_report(timings: dict, outcomes: Counter, elapsed: float):
+    print(
+        f"\nReplayed {sum(outcomes.values())} webhooks in {elapsed:.1f}s: "
+        + ", ".join(f"{count} {outcome}" for outcome, count in sorted(outcomes.items()))
+    )
+    print(f"\n{'stage':<12} {'count':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+    for stage, values in timings.items():
+        values = sorted(values)
+        print(
+            f"{stage:<12} {len(values):>6} "
+            + " ".join(f"{_percentile(values, q):>8.3f}" for q in (50, 90, 99))
+            + f" {values[-1]:>8.3f}"
+        )
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Replay recorded /notion-webhook payloads through the pipeline"
+    )
+    parser.add_argument("records", nargs="+", help="JSONL files of recorded webhooks")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Webhooks per second; 0 keeps the recorded spacing (scaled by --speed)",
+    )
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Build Notion blocks and properties but do not send them",
+    )
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        help="Call the real OpenRouter and Notion APIs instead of local stand-ins",
+    )
+    parser.add_argument("--llm-latency", type=float, default=2.0)
+    parser.add_argument("--notion-latency", type=float, default=0.3)
+    parser.add_argument(
+        "--source-file",
+        help="Local document used for every webhook instead of downloading its file",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        help="Checkpoint directory for replayed jobs (default: a new temporary one)",
+    )
+    parser.add_argument("--json", help="Also write the stage timings to this file")
+    args = parser.parse_args(argv)
+
+    records = load_records(args.records) * args.repeat
+    if not records:
+        parser.error("No recorded webhooks found")
+
+    # Settings are read when the pipeline modules are imported. Replayed jobs
+    # must never be picked up by the service's own checkpoint store
+    os.environ["CHECKPOINT_DIR"] = args.checkpoint_dir or tempfile.mkdtemp(
+        prefix="replay-"
+    )
+    if args.dry_run:
+        os.environ["NOTION_DRY_RUN"] = "true"
+    if not args.live:
+        server = start_stand_ins(args.llm_latency, args.notion_latency)
+        stand_in_url = f"http://127.0.0.1:{server.server_port}"
+        os.environ["OPENROUTER_URL"] = f"{stand_in_url}/chat/completions"
+        os.environ["NOTION_API_URL"] = stand_in_url
+        logger.info(f"Serving OpenRouter and Notion stand-ins at {stand_in_url}")
+
+    from admission import admission
+    from checkpoints import store
+    from pipeline import parse_webhook_payload, run_job
+    from scheduler import DEFAULT_PRIORITY, PRIORITIES, job_context
+    from tracing import start_trace
+
+    lock = threading.Lock()
+    timings = defaultdict(list)
+    outcomes = Counter()
+
+    def record_stage(stage: str, seconds: float):
+        with lock:
+            timings[stage].append(seconds)
+
+    def replay_one(record: dict):
+        headers = record.get("headers", {})
+        priority = headers.get("x-priority", DEFAULT_PRIORITY)
+        if priority not in PRIORITIES:
+            priority = DEFAULT_PRIORITY
+        start = time.perf_counter()
+        try:
+            page_id, source_url, database_id = parse_webhook_payload(record["payload"])
+            tenant = headers.get("x-workspace-id") or database_id
+            with start_trace("replay webhook"), job_context(
+                priority, tenant
+            ), admission.admit():
+                job_id = store.create_job(page_id, args.source_file or source_url)
+                result = run_job(
+                    job_id,
+                    allow_local=args.source_file is not None,
+                    on_stage=record_stage,
+                )
+            outcome = "succeeded" if result["status"] == "success" else "deferred"
+        except Exception as e:
+            status_code = getattr(e, "status_code", None)
+            outcome = f"failed ({status_code})" if status_code else "failed"
+            logger.error(f"Replay failed: {getattr(e, 'detail', str(e))}")
+        with lock:
+            outcomes[outcome] += 1
+            if outcome == "succeeded":
+                timings["total"].append(time.perf_counter() - start)
+
+    logger.info(
+        f"Replaying {len(records)} webhooks with concurrency {args.concurrency}"
+    )
+    start = time.perf_counter()
+    previous_at = None
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for record in records:
+            received_at = record.get("received_at")
+            if args.rate > 0:
+                time.sleep(1 / args.rate)
+            elif received_at is not None and previous_at is not None:
+                time.sleep(max(0.0, received_at - previous_at) / args.speed)
+            previous_at = received_at
+            pool.submit(replay_one, record)
+    elapsed = time.perf_counter() - start
+
+    print_report(timings, outcomes, elapsed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"elapsed": elapsed, "outcomes": outcomes, "timings": timings},
+                f,
+                indent=2,
+            )
+    return 0 if outcomes["succeeded"] == len(records) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
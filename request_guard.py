@@ -0,0 +1,138 @@
+import hashlib
+import hmac
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Optional
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Notion automation payloads are a few kilobytes; anything far larger is junk
+MAX_WEBHOOK_BYTES = int(os.getenv("MAX_WEBHOOK_BYTES", str(256 * 1024)))
+# Verification token of a Notion integration webhook subscription. When set,
+# events signed with it are accepted without an access-token header
+NOTION_WEBHOOK_SECRET = os.getenv("NOTION_WEBHOOK_SECRET")
+SIGNATURE_HEADER = "x-notion-signature"
+# Usage and rate limits of signed requests are charged to this key
+SIGNED_KEY = "notion-signed"
+# Notion's unsigned subscription handshake, {"verification_token": "..."}
+MAX_VERIFICATION_BYTES = 1024
+# Handshakes share one rate limit bucket under this key
+VERIFICATION_KEY = "notion-verification"
+# Jobs each API key may start per minute, with bursts of up to
+# RATE_LIMIT_BURST; 0 means unlimited
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "60"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "20"))
+
+# Every automation webhook the pipeline accepts has these somewhere in its
+# body; signed integration events name the page as their entity
+AUTOMATION_FIELDS = ("id", "files")
+EVENT_FIELDS = ("type", "entity")
+
+
+class RateLimiter:
+    """A token bucket per API key fingerprint."""
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def check(self, key: str):
+        """
+        Take a token from the key's bucket.
+
+        Raises:
+            HTTPException: 429 with a Retry-After header if the bucket is empty
+        """
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                retry_after = math.ceil((1 - tokens) / self.rate)
+            else:
+                self._buckets[key] = (tokens - 1, now)
+                return
+        logger.warning(f"Rate limit exceeded for key {key}")
+        raise HTTPException(
+            status_code=429,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST)
+
+
+def verify_signature(body: bytes, signature: Optional[str]) -> bool:
+    """
+    Check a Notion webhook signature, "sha256=" followed by the hex
+    HMAC-SHA256 of the raw body keyed with NOTION_WEBHOOK_SECRET.
+    """
+    if not NOTION_WEBHOOK_SECRET or not signature:
+        return False
+    expected = hmac.new(
+        NOTION_WEBHOOK_SECRET.encode(), body, hashlib.sha256
+    ).hexdigest()
+    return hmac.compare_digest(f"sha256={expected}", signature.strip())
+
+
+async def read_limited_body(request: Request, limit: int = MAX_WEBHOOK_BYTES) -> bytes:
+    """
+    Read a request body, refusing it as soon as it is known to exceed limit.
+
+    Raises:
+        HTTPException: 413 if the declared or actual length exceeds limit
+    """
+    declared = request.headers.get("content-length")
+    if declared is not None and (not declared.isdigit() or int(declared) > limit):
+        raise HTTPException(status_code=413, detail="Request body too large")
+
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise HTTPException(status_code=413, detail="Request body too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def precheck_webhook_body(body: bytes, fields: tuple = AUTOMATION_FIELDS):
+    """
+    Reject bodies that cannot be a file webhook before parsing them.
+
+    Raises:
+        HTTPException: 400 if a required field name does not appear in the body
+    """
+    for field in fields:
+        if f'"{field}"'.encode() not in body:
+            raise HTTPException(
+                status_code=400, detail=f"Webhook payload has no {field} field"
+            )
+
+
+def verification_token(body: bytes) -> Optional[str]:
+    """Return the token of a subscription handshake body, or None."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or list(data) != ["verification_token"]:
+        return None
+    token = data["verification_token"]
+    return token if isinstance(token, str) else None
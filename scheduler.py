@@ -0,0 +1,146 @@
+import contextvars
+import itertools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Priority classes, highest first
+PRIORITIES = ["interactive", "batch", "background"]
+DEFAULT_PRIORITY = "interactive"
+DEFAULT_TENANT = "default"
+
+
+def _parse_weights(value: str) -> dict:
+    """Parse "workspace-a:2,workspace-b:1" into a weight per tenant."""
+    weights = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        tenant, _, weight = item.rpartition(":")
+        weights[tenant] = float(weight)
+    return weights
+
+
+# Relative share of each stage a tenant gets when several are queued
+TENANT_WEIGHTS = _parse_weights(os.getenv("TENANT_WEIGHTS", ""))
+
+
+@dataclass(frozen=True)
+class JobContext:
+    priority: str = DEFAULT_PRIORITY
+    tenant: str = DEFAULT_TENANT
+
+
+_current_job = contextvars.ContextVar("current_job", default=JobContext())
+
+
+def current_job() -> JobContext:
+    """Return the priority class and tenant of the job running in this context."""
+    return _current_job.get()
+
+
+@contextmanager
+def job_context(priority: str = DEFAULT_PRIORITY, tenant: str = DEFAULT_TENANT):
+    """Run the enclosed pipeline work under a priority class and tenant."""
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority class: {priority}")
+    token = _current_job.set(JobContext(priority, tenant or DEFAULT_TENANT))
+    try:
+        yield
+    finally:
+        _current_job.reset(token)
+
+
+@dataclass
+class _Waiter:
+    rank: int
+    tenant: str
+    seq: int
+    enqueued_at: float
+
+
+class FairQueue:
+    """
+    Orders the jobs waiting for one stage.
+
+    Higher priority classes always go first. Within a class, tenants share
+    the stage by start-time fair queuing: each grant advances the tenant's
+    virtual time by 1/weight, and the waiter whose tenant has the lowest
+    virtual time goes next. A single tenant backfilling hundreds of files
+    therefore cannot starve another tenant's occasional requests.
+
+    Not thread safe; callers hold the admission controller's lock.
+    """
+
+    def __init__(self, weights: dict = None):
+        self.weights = weights if weights is not None else TENANT_WEIGHTS
+        self.waiters = []
+        self.virtual_time = {}
+        self.clock = 0.0
+        self._seq = itertools.count()
+
+    def push(self, job: JobContext) -> _Waiter:
+        waiter = _Waiter(
+            PRIORITIES.index(job.priority), job.tenant, next(self._seq), time.time()
+        )
+        self.waiters.append(waiter)
+        return waiter
+
+    def _start_time(self, tenant: str) -> float:
+        # A tenant returning after being idle cannot bank credit from the past
+        return max(self.virtual_time.get(tenant, 0.0), self.clock)
+
+    def head(self) -> _Waiter:
+        return min(
+            self.waiters,
+            key=lambda w: (w.rank, self._start_time(w.tenant), w.seq),
+        )
+
+    def grant(self, waiter: _Waiter) -> float:
+        """Remove the waiter, charge its tenant and return how long it waited."""
+        self.waiters.remove(waiter)
+        start = self._start_time(waiter.tenant)
+        self.clock = start
+        self.virtual_time[waiter.tenant] = start + 1.0 / self.weights.get(
+            waiter.tenant, 1.0
+        )
+        return time.time() - waiter.enqueued_at
+
+    def remove(self, waiter: _Waiter):
+        self.waiters.remove(waiter)
+
+    def depth_by_class(self) -> dict:
+        depth = dict.fromkeys(PRIORITIES, 0)
+        for waiter in self.waiters:
+            depth[PRIORITIES[waiter.rank]] += 1
+        return depth
+
+
+class WaitStats:
+    """Running wait-time totals for one priority class."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> dict:
+        return {
+            "waits": self.count,
+            "avg_wait_seconds": (
+                round(self.total / self.count, 3) if self.count else 0.0
+            ),
+            "max_wait_seconds": round(self.max, 3),
+        }
@@ -0,0 +1,101 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+from checkpoints import CHECKPOINT_DIR
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SEARCH_INDEX_PATH = os.getenv(
+    "SEARCH_INDEX_PATH", os.path.join(CHECKPOINT_DIR, "search.sqlite3")
+)
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+    doc_id UNINDEXED,
+    page_id UNINDEXED,
+    source_url UNINDEXED,
+    updated_at UNINDEXED,
+    title,
+    summary,
+    body,
+    tokenize = 'porter unicode61'
+)
+"""
+
+
+def _match_expression(query: str) -> str:
+    """Quote each term so user input is never parsed as FTS5 syntax."""
+    terms = query.split()
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+class SearchIndex:
+    """Local SQLite FTS5 index of every processed document's text and summary."""
+
+    def __init__(self, path: str = SEARCH_INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+
+    def add_document(
+        self,
+        doc_id: str,
+        title: str,
+        summary: str,
+        body: str,
+        page_id: str = None,
+        source_url: str = None,
+    ):
+        """
+        Index a document, replacing any earlier version with the same ID.
+
+        A version without a page_id, e.g. from /convert-from-url or
+        bulk_convert, keeps the Notion page an earlier version was linked to.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN")
+            if page_id is None:
+                row = self._conn.execute(
+                    "SELECT page_id FROM documents WHERE doc_id = ?", (doc_id,)
+                ).fetchone()
+                page_id = row["page_id"] if row is not None else None
+            self._conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+            self._conn.execute(
+                "INSERT INTO documents"
+                " (doc_id, page_id, source_url, updated_at, title, summary, body)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (doc_id, page_id, source_url, time.time(), title, summary, body),
+            )
+            self._conn.execute("COMMIT")
+        logger.info(f"Indexed document {doc_id}")
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """Return the best matching documents, most relevant first."""
+        expression = _match_expression(query)
+        if not expression:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT doc_id, page_id, source_url, title,"
+                " snippet(documents, -1, '**', '**', '…', 16)"
+                " AS snippet, bm25(documents, 0, 0, 0, 0, 10.0, 4.0, 1.0) AS score"
+                " FROM documents WHERE documents MATCH ?"
+                " ORDER BY score LIMIT ?",
+                (expression, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+search_index = SearchIndex()
@@ -0,0 +1,362 @@
+import logging
+import os
+import re
+import shutil
+import time
+import zipfile
+from contextlib import ExitStack
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from typing import Callable, List, Optional
+from urllib.parse import urljoin, urlparse
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from admission import MAX_FILE_BYTES, admission
+from http_client import create_client
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "2"))
+# Heavy formats (PDF) are parsed in their own small pool each; the cheaper
+# formats share one larger pool
+EXTRACT_CONCURRENCY = int(os.getenv("EXTRACT_CONCURRENCY", "1"))
+LIGHT_EXTRACT_CONCURRENCY = int(os.getenv("LIGHT_EXTRACT_CONCURRENCY", "4"))
+# Longest a single download may take, however steadily bytes arrive
+DOWNLOAD_DEADLINE_SECONDS = float(os.getenv("DOWNLOAD_DEADLINE_SECONDS", "600"))
+
+# Matches the file ID in every Google Drive link format we accept
+DRIVE_FILE_ID_PATTERN = re.compile(r"(?:/file/d/|/d/|[?&]id=)([a-zA-Z0-9_-]+)")
+
+# Hosts Notion serves uploaded files from
+NOTION_FILE_HOSTS = ("file.notion.so", "prod-files-secure.s3.us-west-2.amazonaws.com")
+
+DRIVE_DOWNLOAD_URL = "https://drive.google.com/uc"
+# Old-style "download anyway" links on Drive's virus scan warning page
+DRIVE_CONFIRM_PATTERN = re.compile(r"confirm=([0-9A-Za-z_-]+)")
+MAX_DRIVE_PAGE_BYTES = 1024 * 1024
+
+SNIFF_BYTES = 512
+
+download_client = create_client("download", pool_size=DOWNLOAD_CONCURRENCY)
+
+
+@dataclass
+class SourceFetcher:
+    """
+    A way of fetching a source document to a local file.
+
+    matches decides whether a source string is handled by this fetcher and
+    fetch writes the document to the given path. A fetcher that cannot stream
+    holds the whole document in memory, so it reserves MAX_FILE_BYTES of the
+    byte budget while it runs.
+    """
+
+    name: str
+    matches: Callable[[str], bool]
+    fetch: Callable[[str, str], None]
+    can_stream: bool
+    max_concurrency: int
+    local: bool = False
+
+    @property
+    def stage(self) -> str:
+        return f"download:{self.name}"
+
+
+@dataclass
+class FormatConverter:
+    """
+    A document format MarkItDown can convert, recognised from its leading bytes.
+
+    Heavy converters get their own small extraction pool so cheap formats are
+    not queued behind large PDFs; the rest share the "extract:light" pool.
+    MarkItDown reads every format whole, so extraction always reserves the
+    file size (see markdown_conversion.extract_text).
+    """
+
+    name: str
+    extension: str
+    sniff: Callable[[str, bytes], bool]
+    max_concurrency: int
+    heavy: bool = False
+
+    @property
+    def stage(self) -> str:
+        return f"extract:{self.name}" if self.heavy else "extract:light"
+
+
+FETCHERS: List[SourceFetcher] = []
+CONVERTERS: List[FormatConverter] = []
+
+
+def register_fetcher(fetcher: SourceFetcher):
+    """Register a fetcher. Fetchers are tried in registration order."""
+    FETCHERS.append(fetcher)
+    admission.register_stage(fetcher.stage, fetcher.max_concurrency)
+
+
+def register_converter(converter: FormatConverter):
+    """Register a converter. Converters are tried in registration order."""
+    CONVERTERS.append(converter)
+    admission.register_stage(converter.stage, converter.max_concurrency)
+
+
+def drive_file_id(url: str) -> Optional[str]:
+    """Return the Google Drive file ID in a URL, or None if there is none."""
+    match = DRIVE_FILE_ID_PATTERN.search(url)
+    return match.group(1) if match else None
+
+
+def find_fetcher(source: str, allow_local: bool = False) -> Optional[SourceFetcher]:
+    """Return the first registered fetcher that accepts the source."""
+    for fetcher in FETCHERS:
+        if fetcher.local and not allow_local:
+            continue
+        if fetcher.matches(source):
+            return fetcher
+    return None
+
+
+def detect_converter(file_path: str) -> Optional[FormatConverter]:
+    """Return the converter for a file by sniffing its content."""
+    with open(file_path, "rb") as f:
+        header = f.read(SNIFF_BYTES)
+    for converter in CONVERTERS:
+        if converter.sniff(file_path, header):
+            return converter
+    return None
+
+
+def fetch_source(source: str, output_path: str, allow_local: bool = False):
+    """Fetch a source document to output_path using the matching fetcher."""
+    fetcher = find_fetcher(source, allow_local=allow_local)
+    if fetcher is None:
+        raise HTTPException(
+            status_code=400, detail="No fetcher available for this source"
+        )
+    logger.info(f"Fetching {source} with the {fetcher.name} fetcher")
+    with admission.stage(fetcher.stage), ExitStack() as budget:
+        if not fetcher.can_stream:
+            budget.enter_context(admission.reserve(MAX_FILE_BYTES))
+        fetcher.fetch(source, output_path)
+
+
+# --- Fetchers ---------------------------------------------------------------
+
+
+def _is_drive(source: str) -> bool:
+    if not source.startswith("https://"):
+        # A bare file ID
+        return re.fullmatch(r"[a-zA-Z0-9_-]+", source) is not None
+    host = urlparse(source).netloc
+    return host.endswith("google.com") and drive_file_id(source) is not None
+
+
+class _DriveConfirmForm(HTMLParser):
+    """Finds the "download anyway" form on Drive's virus scan warning page."""
+
+    def __init__(self):
+        super().__init__()
+        self.action = None
+        self.fields = {}
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form" and attrs.get("id") == "download-form":
+            self.action = attrs.get("action")
+        elif tag == "input" and self.action and attrs.get("name"):
+            self.fields[attrs["name"]] = attrs.get("value") or ""
+
+
+def _drive_confirm_request(page: str, base_url: str, file_id: str) -> Optional[tuple]:
+    """
+    Find the URL and parameters that confirm a large Drive download.
+
+    Returns:
+        tuple: The URL and query parameters, or None if the page has no
+        confirmation, e.g. because the file is not shared publicly
+    """
+    form = _DriveConfirmForm()
+    form.feed(page)
+    if form.action:
+        return urljoin(base_url, form.action), form.fields
+    match = DRIVE_CONFIRM_PATTERN.search(page)
+    if match:
+        return DRIVE_DOWNLOAD_URL, {
+            "export": "download",
+            "id": file_id,
+            "confirm": match.group(1),
+        }
+    return None
+
+
+def _fetch_drive(source: str, output_path: str):
+    """
+    Download a publicly shared Google Drive file through the pooled client.
+
+    Files too large for Drive's virus scan answer with a warning page
+    first; its confirmation form is submitted to get the file itself.
+    """
+    file_id = drive_file_id(source) if source.startswith("https://") else source
+    logger.info(f"Starting download for file ID: {file_id}")
+
+    params = {"export": "download", "id": file_id}
+    with download_client.get(
+        DRIVE_DOWNLOAD_URL, params=params, stream=True
+    ) as response:
+        if response.status_code == 200 and not _is_html(response):
+            _stream_to_file(response, output_path)
+            return
+        if response.status_code != 200:
+            logger.error(f"Drive download returned HTTP {response.status_code}")
+            raise HTTPException(
+                status_code=400, detail="Failed to download file from Google Drive"
+            )
+        # Warning pages are small; anything else is not worth reading
+        page = response.raw.read(MAX_DRIVE_PAGE_BYTES, decode_content=True).decode(
+            response.encoding or "utf-8", errors="replace"
+        )
+        confirm = _drive_confirm_request(page, response.url, file_id)
+
+    if confirm is None:
+        logger.error("Drive returned a page without a download confirmation")
+        raise HTTPException(
+            status_code=400,
+            detail="Failed to download file from Google Drive. Please ensure it is publicly accessible.",
+        )
+    url, params = confirm
+    with download_client.get(url, params=params, stream=True) as response:
+        if response.status_code != 200 or _is_html(response):
+            logger.error(
+                f"Drive confirmed download returned HTTP {response.status_code}"
+            )
+            raise HTTPException(
+                status_code=400, detail="Failed to download file from Google Drive"
+            )
+        _stream_to_file(response, output_path)
+
+
+def _is_html(response) -> bool:
+    return response.headers.get("Content-Type", "").startswith("text/html")
+
+
+def _is_notion_file(source: str) -> bool:
+    if not source.startswith("https://"):
+        return False
+    parsed = urlparse(source)
+    return parsed.netloc in NOTION_FILE_HOSTS or parsed.path.startswith(
+        "/secure.notion-static.com/"
+    )
+
+
+def _is_https(source: str) -> bool:
+    return source.startswith("https://")
+
+
+def _stream_to_file(response, output_path: str):
+    """
+    Write a streamed response to disk, stopping as soon as it exceeds
+    MAX_FILE_BYTES or takes longer than DOWNLOAD_DEADLINE_SECONDS.
+    """
+    deadline = time.monotonic() + DOWNLOAD_DEADLINE_SECONDS
+    content_length = int(response.headers.get("Content-Length") or 0)
+    if content_length > MAX_FILE_BYTES:
+        raise HTTPException(status_code=413, detail="File is too large to be processed")
+
+    written = 0
+    with open(output_path, "wb") as f:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            written += len(chunk)
+            if written > MAX_FILE_BYTES:
+                raise HTTPException(
+                    status_code=413, detail="File is too large to be processed"
+                )
+            if time.monotonic() > deadline:
+                raise HTTPException(status_code=504, detail="Download took too long")
+            f.write(chunk)
+
+
+def _fetch_https(source: str, output_path: str):
+    """Stream a URL to disk through the pooled download client."""
+    with download_client.get(source, stream=True) as response:
+        if response.status_code != 200:
+            logger.error(f"Download returned HTTP {response.status_code}")
+            raise HTTPException(status_code=400, detail="Failed to download file")
+        _stream_to_file(response, output_path)
+
+
+def _is_local(source: str) -> bool:
+    return os.path.isfile(source)
+
+
+def _fetch_local(source: str, output_path: str):
+    shutil.copyfile(source, output_path)
+
+
+register_fetcher(
+    SourceFetcher("drive", _is_drive, _fetch_drive, True, DOWNLOAD_CONCURRENCY)
+)
+register_fetcher(
+    SourceFetcher("notion", _is_notion_file, _fetch_https, True, DOWNLOAD_CONCURRENCY)
+)
+register_fetcher(
+    SourceFetcher("https", _is_https, _fetch_https, True, DOWNLOAD_CONCURRENCY)
+)
+register_fetcher(SourceFetcher("local", _is_local, _fetch_local, True, 8, local=True))
+
+
+# --- Converters -------------------------------------------------------------
+
+
+def _zip_contains(file_path: str, header: bytes, member: str) -> bool:
+    if not header.startswith(b"PK\x03\x04"):
+        return False
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            return member in archive.namelist()
+    except zipfile.BadZipFile:
+        return False
+
+
+def _sniff_html(file_path: str, header: bytes) -> bool:
+    start = header.lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    return start.startswith((b"<!doctype html", b"<html"))
+
+
+register_converter(
+    FormatConverter(
+        "pdf",
+        ".pdf",
+        lambda path, header: header.startswith(b"%PDF"),
+        max_concurrency=EXTRACT_CONCURRENCY,
+        heavy=True,
+    )
+)
+register_converter(
+    FormatConverter(
+        "docx",
+        ".docx",
+        lambda path, header: _zip_contains(path, header, "word/document.xml"),
+        max_concurrency=LIGHT_EXTRACT_CONCURRENCY,
+    )
+)
+register_converter(
+    FormatConverter(
+        "pptx",
+        ".pptx",
+        lambda path, header: _zip_contains(path, header, "ppt/presentation.xml"),
+        max_concurrency=LIGHT_EXTRACT_CONCURRENCY,
+    )
+)
+register_converter(
+    FormatConverter(
+        "html",
+        ".html",
+        _sniff_html,
+        max_concurrency=LIGHT_EXTRACT_CONCURRENCY,
+    )
+)
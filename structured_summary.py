@@ -0,0 +1,248 @@
+import json
+import logging
+import re
+from typing import Annotated, List
+from fastapi import HTTPException
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from openrouter import chat_completion
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Repair requests allowed before the job is given up on
+MAX_REPAIR_ATTEMPTS = 2
+
+
+class StructuredSummary(BaseModel):
+    title: str = Field(
+        min_length=1,
+        description="The document's title as it appears in the source text.",
+    )
+    abstract: str = Field(
+        min_length=1,
+        description="Key objectives, methods, results and conclusions in 3-4 sentences.",
+    )
+    background: str = Field(
+        min_length=1,
+        description="Context, problem or research motivation in 2-3 sentences.",
+    )
+    materials: List[str] = Field(
+        description="Key materials and their sources, one short item each."
+    )
+    methods: List[str] = Field(
+        min_length=1,
+        description="Main steps including key equipment and parameters, one sentence each.",
+    )
+    results: str = Field(min_length=1, description="Key findings in 3-4 sentences.")
+    discussion: str = Field(
+        min_length=1,
+        description="Interpretation of the results and their significance in 3-4 sentences.",
+    )
+    conclusion: str = Field(
+        min_length=1,
+        description="Implications and any recommendations in 2-3 sentences.",
+    )
+
+
+FIELDS = list(StructuredSummary.model_fields)
+# Fields rendered as sections of the page body; the title goes to page properties
+SECTIONS = [name for name in FIELDS if name != "title"]
+
+# Headings used when rendering, in document order
+SECTION_TITLES = {
+    "abstract": "Abstract",
+    "background": "Background",
+    "materials": "Materials",
+    "methods": "Methods",
+    "results": "Results",
+    "discussion": "Discussion",
+    "conclusion": "Conclusion",
+}
+
+# Validators for one section at a time, keeping each field's constraints
+_SECTION_ADAPTERS = {
+    name: TypeAdapter(Annotated[field.annotation, field])
+    for name, field in StructuredSummary.model_fields.items()
+}
+
+
+# Keywords every provider's strict JSON schema mode understands; length
+# constraints are enforced by our own validation instead
+_SCHEMA_KEYWORDS = ("type", "items", "description")
+
+
+def _response_format(sections: list) -> dict:
+    """A strict JSON schema response_format covering only the given sections."""
+    properties = StructuredSummary.model_json_schema()["properties"]
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "paper_summary",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    name: {
+                        key: value
+                        for key, value in properties[name].items()
+                        if key in _SCHEMA_KEYWORDS
+                    }
+                    for name in sections
+                },
+                "required": sections,
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def build_structured_messages(source_text: str) -> list:
+    """Build the chat messages asking for a JSON summary of the source text."""
+    return [
+        {
+            "role": "user",
+            "content": (
+                "You are a helpful assistant.\n\n"
+                "**Task:**\n"
+                "Summarise the extracted text from a PDF as a JSON object with the "
+                "keys title, abstract, background, materials, methods, results, "
+                "discussion and conclusion. 'title' is the document's own title. "
+                "Use short, to-the-point sentences in simple, direct language with "
+                "a professional tone. 'materials' is a list of key "
+                "materials and their sources; 'methods' is an ordered list of steps, "
+                "each no more than one sentence. All other keys are plain text.\n"
+                "Return only the JSON object.\n\n"
+                "**Source Text:**\n"
+                f"{source_text}\n"
+            ),
+        }
+    ]
+
+
+def _parse_json_object(content: str) -> dict:
+    """Parse the model's reply, tolerating code fences or surrounding prose."""
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        match = re.search(r"\{.*\}", content, re.DOTALL)
+        if not match:
+            return {}
+        try:
+            data = json.loads(match.group())
+        except json.JSONDecodeError:
+            return {}
+    return data if isinstance(data, dict) else {}
+
+
+def validate_sections(data: dict) -> tuple:
+    """
+    Validate each section on its own
+
+    Returns:
+        tuple: A dict of valid sections and a dict of errors for the rest
+    """
+    valid, errors = {}, {}
+    for name in FIELDS:
+        if name not in data:
+            errors[name] = "missing"
+            continue
+        try:
+            valid[name] = _SECTION_ADAPTERS[name].validate_python(data[name])
+        except ValidationError as e:
+            errors[name] = e.errors()[0]["msg"]
+    return valid, errors
+
+
+def _repair_sections(messages: list, errors: dict) -> dict:
+    """Ask again for every invalid section in one request until they validate."""
+    repaired = {}
+    for attempt in range(1, MAX_REPAIR_ATTEMPTS + 1):
+        logger.info(f"Repairing sections {errors}, attempt {attempt}")
+        problems = ", ".join(f"'{name}' ({error})" for name, error in errors.items())
+        repair_messages = messages + [
+            {
+                "role": "user",
+                "content": (
+                    f"These sections of your summary were invalid: {problems}. "
+                    f"Return only a JSON object containing corrected "
+                    f"{', '.join(errors)} sections."
+                ),
+            }
+        ]
+        data = _parse_json_object(
+            chat_completion(
+                repair_messages, response_format=_response_format(list(errors))
+            )
+        )
+        remaining = {}
+        for name, error in errors.items():
+            try:
+                repaired[name] = _SECTION_ADAPTERS[name].validate_python(data[name])
+            except KeyError:
+                remaining[name] = "missing"
+            except ValidationError as e:
+                remaining[name] = e.errors()[0]["msg"]
+        errors = remaining
+        if not errors:
+            return repaired
+    logger.error(
+        f"Sections still invalid after {MAX_REPAIR_ATTEMPTS} repairs: {errors}"
+    )
+    raise HTTPException(
+        status_code=500,
+        detail=f"OpenRouter returned invalid sections: {', '.join(errors)}",
+    )
+
+
+def summarise_structured(source_text: str) -> dict:
+    """
+    Summarise text into the StructuredSummary sections
+
+    Sections that fail validation are requested again together in one
+    repair request instead of rerunning the whole summary. A reply that is
+    not JSON at all is rerun once in full, and then given up on.
+
+    Args:
+        source_text: Source text, normally already passed through preprocess_text
+
+    Returns:
+        dict: The validated sections
+    """
+    logger.info("Sending request to OpenRouter for a structured summary")
+    messages = build_structured_messages(source_text)
+    content = chat_completion(messages, response_format=_response_format(FIELDS))
+    data = _parse_json_object(content)
+    if not data:
+        logger.warning("Structured summary reply was not a JSON object; retrying")
+        content = chat_completion(messages, response_format=_response_format(FIELDS))
+        data = _parse_json_object(content)
+        if not data:
+            logger.error("Structured summary reply was not a JSON object again")
+            raise HTTPException(
+                status_code=500, detail="OpenRouter did not return a JSON summary"
+            )
+
+    summary, errors = validate_sections(data)
+    if errors:
+        logger.warning(f"Invalid summary sections: {errors}")
+        messages.append({"role": "assistant", "content": content})
+        summary.update(_repair_sections(messages, errors))
+
+    logger.info("Structured summary complete")
+    return StructuredSummary(**summary).model_dump()
+
+
+def summary_to_markdown(summary: dict) -> str:
+    """Render a structured summary as markdown."""
+    lines = []
+    for name in SECTIONS:
+        lines.append(f"**{SECTION_TITLES[name]}**")
+        value = summary[name]
+        if name == "materials":
+            lines.extend(f"* {item}" for item in value)
+        elif name == "methods":
+            lines.extend(f"{i}. {step}" for i, step in enumerate(value, 1))
+        else:
+            lines.append(value)
+        lines.append("")
+    return "\n".join(lines).strip()
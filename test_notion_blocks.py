@@ -0,0 +1,47 @@
+import json
+import os
+from pathlib import Path
+import pytest
+from make_notion_block import NotionBlockMaker
+from markdown_sections import split_sections
+from notion_blocks import encode_blocks
+
+# Summaries as models return them, each with the sections and Notion blocks
+# they must produce in a JSON file of the same name
+FIXTURES_DIR = Path(__file__).parent / "fixtures" / "model_outputs"
+# Set to rewrite the expected JSON from the current output, then review the diff
+UPDATE_GOLDEN = os.getenv("UPDATE_GOLDEN") == "1"
+
+FIXTURES = sorted(path.stem for path in FIXTURES_DIR.glob("*.md"))
+
+
+def render(markdown_content: str) -> dict:
+    """The sections and blocks built from a summary, in their JSON form."""
+    sections = split_sections(markdown_content)
+    blocks = NotionBlockMaker(dry_run=True).build_blocks(markdown_content)
+    return {
+        "sections": [
+            {"level": section.level, "title": section.title} for section in sections
+        ],
+        "blocks": json.loads(encode_blocks(blocks)),
+    }
+
+
+@pytest.mark.parametrize("name", FIXTURES)
+def test_model_output_matches_golden(name):
+    markdown_content = (FIXTURES_DIR / f"{name}.md").read_text(encoding="utf-8")
+    expected_path = FIXTURES_DIR / f"{name}.json"
+    actual = render(markdown_content)
+
+    if UPDATE_GOLDEN:
+        expected_path.write_text(
+            json.dumps(actual, indent=2, ensure_ascii=False) + "\n", encoding="utf-8"
+        )
+    expected = json.loads(expected_path.read_text(encoding="utf-8"))
+
+    assert actual["sections"] == expected["sections"]
+    assert actual["blocks"] == expected["blocks"]
+
+
+def test_fixtures_cover_every_heading_style():
+    assert {"atx_levels", "bold_colons", "plain_titles", "preamble"} <= set(FIXTURES)
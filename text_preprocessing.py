@@ -0,0 +1,176 @@
+import logging
+import os
+import re
+from collections import Counter
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Maximum number of tokens of source text sent to the LLM
+MAX_SOURCE_TOKENS = int(os.getenv("MAX_SOURCE_TOKENS", "60000"))
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Rough characters-per-token ratio used when tiktoken is unavailable
+CHARS_PER_TOKEN = 4
+
+_encoding = None
+_encoding_loaded = False
+
+# Headings that start back matter which adds nothing to a summary
+_BACK_MATTER_PATTERN = re.compile(
+    r"^\s*(?:\d+\.?\s*)?(?:references|bibliography|works cited|literature cited|"
+    r"acknowledge?ments?|funding|conflicts? of interest|competing interests|"
+    r"author contributions)\s*:?\s*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def _get_encoding():
+    """
+    Load the tiktoken encoding on first use.
+
+    tiktoken downloads its BPE file the first time, so a failure here (for
+    example with no network access) falls back to estimating token counts.
+    """
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        if tiktoken is not None:
+            try:
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                logger.warning(f"Could not load tiktoken encoding: {str(e)}")
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens with tiktoken when available, otherwise estimate them."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _normalise_line(line: str) -> str:
+    # Page numbers change from page to page, so ignore digits when comparing
+    return re.sub(r"\d+", "#", line.strip().lower())
+
+
+def _edge_indexes(lines: list, edge_lines: int) -> set:
+    """Indexes of the first and last edge_lines non-blank lines of a page."""
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    return set(filled[:edge_lines] + filled[-edge_lines:])
+
+
+def remove_repeated_headers(text: str, edge_lines: int = 2) -> str:
+    """
+    Remove running headers and footers.
+
+    MarkItDown separates PDF pages with form feeds. Lines near the top or bottom
+    of a page that recur there on at least half of the pages are dropped from
+    those edges only, so body text that happens to match one (such as a table
+    value matching a page number) is kept.
+    """
+    pages = [page.split("\n") for page in text.split("\f")]
+    if len(pages) < 3:
+        return text
+
+    edges = [_edge_indexes(lines, edge_lines) for lines in pages]
+    counts = Counter()
+    for lines, indexes in zip(pages, edges):
+        counts.update({_normalise_line(lines[i]) for i in indexes})
+
+    threshold = max(2, len(pages) // 2)
+    repeated = {line for line, count in counts.items() if count >= threshold}
+    if not repeated:
+        return text
+
+    logger.info(f"Removing {len(repeated)} repeated header/footer lines")
+    return "\n".join(
+        line
+        for lines, indexes in zip(pages, edges)
+        for i, line in enumerate(lines)
+        if i not in indexes or _normalise_line(line) not in repeated
+    )
+
+
+def strip_back_matter(text: str) -> str:
+    """
+    Drop references, acknowledgements and similar sections.
+
+    Only headings in the second half of the document count, so a table of
+    contents listing "References" does not truncate the whole paper.
+    """
+    for match in _BACK_MATTER_PATTERN.finditer(text):
+        if match.start() >= len(text) // 2:
+            logger.info(f"Stripping back matter from heading: {match.group().strip()}")
+            return text[: match.start()]
+    return text
+
+
+def normalise_whitespace(text: str) -> str:
+    """Join hyphenated line breaks and collapse runs of whitespace."""
+    text = text.replace("\f", "\n")
+    text = re.sub(r"([a-z])-\n\s*([a-z])", r"\1\2", text)
+    text = re.sub(r"[ \t\xa0]+", " ", text)
+    text = re.sub(r" *\n *", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+def trim_to_token_budget(text: str, max_tokens: int) -> str:
+    """Trim text to at most max_tokens, preferring to cut at a paragraph break."""
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    encoding = _get_encoding()
+    if encoding is not None:
+        trimmed = encoding.decode(
+            encoding.encode(text, disallowed_special=())[:max_tokens]
+        )
+    else:
+        trimmed = text[: max_tokens * CHARS_PER_TOKEN]
+
+    paragraph_end = trimmed.rfind("\n\n")
+    if paragraph_end > len(trimmed) * 0.8:
+        trimmed = trimmed[:paragraph_end]
+    return trimmed
+
+
+def preprocess_text(raw_text: str, max_tokens: int = MAX_SOURCE_TOKENS) -> tuple:
+    """
+    Shrink extracted text before it is sent to the LLM
+
+    Args:
+        raw_text: Text extracted by MarkItDown
+        max_tokens: Token budget for the returned text
+
+    Returns:
+        tuple: The cleaned text and a dict of before/after token counts
+    """
+    tokens_before = count_tokens(raw_text)
+
+    text = remove_repeated_headers(raw_text)
+    text = normalise_whitespace(text)
+    text = strip_back_matter(text)
+    text = trim_to_token_budget(text, max_tokens)
+
+    tokens_after = count_tokens(text)
+    reduction = 1 - tokens_after / tokens_before if tokens_before else 0.0
+    logger.info(
+        f"Preprocessed source text: {tokens_before} -> {tokens_after} tokens "
+        f"({reduction:.0%} reduction)"
+    )
+    return text, {
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "reduction": round(reduction, 3),
+    }
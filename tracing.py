@@ -0,0 +1,312 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+import requests
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Share of new traces whose spans are recorded; 0 only mints IDs for the logs
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# Append finished spans to this JSONL file, one span per line
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+# OTLP/HTTP JSON endpoint of a collector, e.g. http://localhost:4318/v1/traces
+TRACE_COLLECTOR_URL = os.getenv("TRACE_COLLECTOR_URL")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "pdf-to-notion")
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "2"))
+# Spans waiting for export; when full, new spans are dropped
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_BATCH_SIZE = 512
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+
+# W3C trace context: version-trace_id-parent_id-flags
+_TRACEPARENT_PATTERN = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    One timed operation in a trace.
+
+    Spans of unsampled traces still carry the trace ID, so logs and
+    outbound requests can be correlated, but record nothing and are
+    never exported.
+    """
+
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "kind",
+        "sampled",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "error",
+    )
+
+    def __init__(
+        self,
+        trace_id: str,
+        parent_id: Optional[str],
+        name: str,
+        kind: int,
+        sampled: bool,
+        attributes: dict,
+    ):
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes if sampled else {}
+        self.error = None
+
+    def set_attributes(self, **attributes):
+        if self.sampled:
+            self.attributes.update(attributes)
+
+    def add(self, name: str, amount: int):
+        """Add to a counter attribute, e.g. bytes sent over several requests."""
+        if self.sampled:
+            self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def _new_id(n_bytes: int) -> str:
+    return os.urandom(n_bytes).hex()
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
+
+
+@contextmanager
+def _activate(span: Span):
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = getattr(e, "detail", None) or str(e) or type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        if span.sampled:
+            span.end_ns = time.time_ns()
+            _export(span)
+
+
+@contextmanager
+def start_trace(
+    name: str, traceparent: Optional[str] = None, kind: int = SERVER, **attributes
+):
+    """
+    Start a new trace, or continue the caller's from a W3C traceparent header.
+
+    A caller's sampling decision is honoured; otherwise the trace is
+    sampled with probability TRACE_SAMPLE_RATE.
+    """
+    match = _TRACEPARENT_PATTERN.fullmatch((traceparent or "").strip().lower())
+    if match:
+        trace_id, parent_id = match.group(1), match.group(2)
+        sampled = int(match.group(3), 16) & 1 == 1
+    else:
+        trace_id, parent_id = _new_id(16), None
+        sampled = TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+    with _activate(Span(trace_id, parent_id, name, kind, sampled, attributes)) as span:
+        yield span
+
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, **attributes):
+    """
+    Time the enclosed block as a child of the current span.
+
+    Outside a sampled trace this yields the current span (or None) and
+    records nothing.
+    """
+    parent = _current_span.get()
+    if parent is None or not parent.sampled:
+        yield parent
+        return
+    with _activate(
+        Span(parent.trace_id, parent.span_id, name, kind, True, attributes)
+    ) as child:
+        yield child
+
+
+def set_attributes(**attributes):
+    """Set attributes on the current span, if it is being recorded."""
+    current = _current_span.get()
+    if current is not None:
+        current.set_attributes(**attributes)
+
+
+class TraceContextFilter(logging.Filter):
+    """Adds the current trace ID to log records as %(trace_id)s."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id() or "-"
+        return True
+
+
+# Export
+
+_queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+_exporter_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_exporter = None
+_dropped = 0
+
+
+def _export(span: Span):
+    global _dropped, _exporter
+    if not (TRACE_EXPORT_PATH or TRACE_COLLECTOR_URL):
+        return
+    try:
+        _queue.put_nowait(span)
+    except queue.Full:
+        _dropped += 1
+        if _dropped % 1000 == 1:
+            logger.warning(f"Trace export queue full; {_dropped} spans dropped")
+        return
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = threading.Thread(target=_export_loop, daemon=True)
+                _exporter.start()
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(span: Span) -> dict:
+    otlp = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [
+            {"key": key, "value": _otlp_value(value)}
+            for key, value in span.attributes.items()
+        ],
+        "status": ({"code": 2, "message": span.error} if span.error else {"code": 1}),
+    }
+    if span.parent_id:
+        otlp["parentSpanId"] = span.parent_id
+    return otlp
+
+
+def _write_batch(spans: list):
+    if TRACE_EXPORT_PATH:
+        with open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict()) + "\n")
+    if TRACE_COLLECTOR_URL:
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": TRACE_SERVICE_NAME},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [_otlp_span(span) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        response = requests.post(TRACE_COLLECTOR_URL, json=body, timeout=10)
+        if response.status_code >= 400:
+            logger.warning(
+                f"Trace collector returned {response.status_code}; "
+                f"{len(spans)} spans lost"
+            )
+
+
+def _drain() -> list:
+    spans = []
+    while len(spans) < TRACE_BATCH_SIZE:
+        try:
+            spans.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return spans
+
+
+def flush():
+    """Export every queued span now, e.g. before a script exits."""
+    with _flush_lock:
+        spans = _drain()
+        while spans:
+            try:
+                _write_batch(spans)
+            except Exception as e:
+                logger.warning(f"Failed to export {len(spans)} spans: {str(e)}")
+            spans = _drain()
+
+
+def _export_loop():
+    while True:
+        time.sleep(TRACE_EXPORT_INTERVAL)
+        flush()
+
+
+atexit.register(flush)
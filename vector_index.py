@@ -0,0 +1,242 @@
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+import numpy as np
+from dotenv import load_dotenv
+from checkpoints import CHECKPOINT_DIR
+from embeddings import HASHING_MODEL
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+VECTOR_INDEX_DIR = os.getenv(
+    "VECTOR_INDEX_DIR", os.path.join(CHECKPOINT_DIR, "vectors")
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS vectors (
+    row INTEGER PRIMARY KEY,
+    doc_id TEXT NOT NULL UNIQUE,
+    page_id TEXT,
+    title TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class VectorIndex:
+    """
+    Unit-length document vectors in a memory-mapped float32 matrix.
+
+    Row i of vectors.f32 belongs to the document with row i in the SQLite
+    table, so adding a document appends one row and replacing one rewrites
+    it in place. Search is a single matrix-vector product over the mapped
+    file, which stays in the low milliseconds at tens of thousands of rows.
+
+    The service and bulk_convert share the directory, so writers take a file
+    lock and reload the row map from SQLite when another process changed it.
+    """
+
+    def __init__(self, directory: str = VECTOR_INDEX_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.lock_path = os.path.join(directory, "vectors.lock")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "vectors.sqlite3"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._conn.executescript(_SCHEMA)
+        self._data_version = None
+
+        with self._locked():
+            # Drop a row written just before a crash but never recorded
+            if self.dim is not None and os.path.exists(self.vectors_path):
+                os.truncate(self.vectors_path, len(self._doc_ids) * self.dim * 4)
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+    @contextmanager
+    def _locked(self):
+        """Hold the thread and cross-process locks with the row map current."""
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Reload the row map if another connection has written to SQLite."""
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+
+        meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+        self.model = meta.get("model")
+        self.dim = int(meta["dim"]) if "dim" in meta else None
+        rows = self._conn.execute(
+            "SELECT doc_id, page_id FROM vectors ORDER BY row"
+        ).fetchall()
+        self._doc_ids = [doc_id for doc_id, _ in rows]
+        self._page_ids = [page_id for _, page_id in rows]
+        self._rows = {doc_id: row for row, doc_id in enumerate(self._doc_ids)}
+        self._matrix = self._unlinkable = None
+
+    def _reset(self, model: str):
+        logger.warning(
+            f"Embedding model changed from {self.model} to {model}; "
+            f"clearing {len(self)} vectors"
+        )
+        self._conn.execute("DELETE FROM vectors")
+        self._conn.execute("DELETE FROM meta")
+        if os.path.exists(self.vectors_path):
+            os.truncate(self.vectors_path, 0)
+        self._doc_ids, self._page_ids, self._rows = [], [], {}
+        self._matrix = self._unlinkable = None
+        self.model, self.dim = None, None
+
+    def add(
+        self,
+        doc_id: str,
+        vector: np.ndarray,
+        model: str,
+        page_id: str = None,
+        title: str = None,
+    ) -> bool:
+        """
+        Add a document's vector, replacing any earlier one with the same ID.
+        Replacing it without a page_id keeps the page it was linked to.
+
+        A vector from a newly configured model replaces the whole index, but
+        one from the hashing fallback never does; it is skipped instead.
+
+        Returns:
+            bool: Whether the vector was added
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._locked():
+            if self.model is not None and (
+                self.model != model or self.dim != len(vector)
+            ):
+                if model == HASHING_MODEL:
+                    logger.warning(
+                        f"Not indexing document {doc_id}: the index holds "
+                        f"{self.model} vectors and only {model} is available"
+                    )
+                    return False
+                self._reset(model)
+            if self.model is None:
+                self.model, self.dim = model, len(vector)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [("model", model), ("dim", str(self.dim))],
+                )
+
+            row = self._rows.get(doc_id)
+            # Write at the row's offset rather than appending, so the file
+            # cannot drift from the row numbers recorded in SQLite
+            fd = os.open(self.vectors_path, os.O_RDWR | os.O_CREAT)
+            try:
+                os.pwrite(
+                    fd,
+                    vector.tobytes(),
+                    (len(self._doc_ids) if row is None else row) * self.dim * 4,
+                )
+            finally:
+                os.close(fd)
+
+            if row is None:
+                row = len(self._doc_ids)
+                self._doc_ids.append(doc_id)
+                self._page_ids.append(page_id)
+                self._rows[doc_id] = row
+                # The mapping no longer covers every row
+                self._matrix = None
+            elif page_id is not None:
+                self._page_ids[row] = page_id
+            self._unlinkable = None
+            self._conn.execute(
+                "INSERT INTO vectors (row, doc_id, page_id, title)"
+                " VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (row) DO UPDATE SET"
+                " page_id = COALESCE(excluded.page_id, page_id),"
+                " title = COALESCE(excluded.title, title)",
+                (row, doc_id, page_id, title),
+            )
+        logger.info(f"Added vector for document {doc_id} ({len(self)} in index)")
+        return True
+
+    def _get_matrix(self) -> np.ndarray:
+        if self._matrix is None:
+            self._matrix = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(self._doc_ids), self.dim),
+            )
+        return self._matrix
+
+    def search(
+        self,
+        vector: np.ndarray,
+        model: str,
+        k: int = 5,
+        exclude: str = None,
+        linkable_only: bool = False,
+    ) -> list:
+        """
+        Return the k most similar documents by cosine similarity.
+
+        Args:
+            vector: A unit-length query vector
+            model: Model that produced the vector; other models' vectors
+                are not comparable, so nothing is returned
+            k: Number of neighbours to return
+            exclude: Document ID to leave out, normally the query document
+            linkable_only: Only return documents that have a Notion page
+
+        Returns:
+            list: Dicts with doc_id, page_id and score, most similar first
+        """
+        with self._lock:
+            self._refresh()
+            if not self._doc_ids or self.model != model or self.dim != len(vector):
+                return []
+            scores = self._get_matrix() @ np.asarray(vector, dtype=np.float32)
+            if linkable_only:
+                if self._unlinkable is None:
+                    self._unlinkable = np.array(
+                        [page_id is None for page_id in self._page_ids]
+                    )
+                scores[self._unlinkable] = -np.inf
+            if exclude in self._rows:
+                scores[self._rows[exclude]] = -np.inf
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                {
+                    "doc_id": self._doc_ids[row],
+                    "page_id": self._page_ids[row],
+                    "score": float(scores[row]),
+                }
+                for row in top
+                if np.isfinite(scores[row])
+            ]
+
+
+vector_index = VectorIndex()